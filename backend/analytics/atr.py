@@ -0,0 +1,113 @@
+"""
+Incremental ATR
+Per-ticker true range and ATR arrays kept between requests. New bars only extend them,
+so a recalc reads the current and entry-date ATR without recomputing the whole history
+"""
+import math
+import os
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from backend.analytics.bars import BarState, BarStateCache, bar_dates
+
+ATR_METHODS = ("sma", "wilder")
+
+# "sma" is the rolling mean of the last ATR_WINDOW true ranges (the original definition),
+# "wilder" is Wilder's smoothing, seeded with that same mean
+ATR_METHOD = os.getenv("ATR_METHOD", "sma").strip().lower()
+if ATR_METHOD not in ATR_METHODS:
+    print(f"⚠️ Unknown ATR_METHOD '{ATR_METHOD}', using sma")
+    ATR_METHOD = "sma"
+
+MAX_ATR_STATES = 1024
+
+
+class ATRSeries(NamedTuple):
+    """Read-only view of one ticker's ATR per bar (NaN until the first full window)"""
+    index: np.ndarray   # datetime64[ns] bar dates
+    values: np.ndarray
+
+    @property
+    def latest(self) -> Optional[float]:
+        if not self.values.size or np.isnan(self.values[-1]):
+            return None
+        return float(round(self.values[-1], 4))
+
+    def at(self, dt: datetime) -> Optional[float]:
+        """ATR on the last bar on or before dt"""
+        idx = int(np.searchsorted(self.index, bar_dates(pd.Timestamp(dt).to_datetime64()), side="right")) - 1
+        if idx < 0 or np.isnan(self.values[idx]):
+            return None
+        return float(round(self.values[idx], 4))
+
+
+class ATRState(BarState):
+    """True range and ATR of one ticker's bars, extended bar by bar as new ones arrive"""
+
+    columns = ("tr", "atr")
+
+    def __init__(self, window: int, method: str):
+        self.window = window
+        self.method = method
+        super().__init__()
+
+    def _extend(self, bars: pd.DataFrame, start: int, end: int):
+        high = bars["High"].to_numpy(dtype=float)
+        low = bars["Low"].to_numpy(dtype=float)
+        prev_close = self.prev_close(start, end)
+        self.tr[start:end] = np.maximum.reduce([high - low, np.abs(high - prev_close), np.abs(low - prev_close)])
+        if self.method == "wilder":
+            self._wilder(start, end)
+        else:
+            self._sma(start, end)
+
+    def _sma(self, start: int, end: int):
+        """Mean of the last `window` true ranges, NaN while any of them is missing"""
+        first = max(start - self.window + 1, 0)
+        tr = self.tr[first:end]
+        valid = ~np.isnan(tr)
+        sums = np.concatenate(([0.0], np.cumsum(np.where(valid, tr, 0.0))))
+        counts = np.concatenate(([0], np.cumsum(valid)))
+        positions = np.arange(start, end) - first + 1
+        lower = np.maximum(positions - self.window, 0)
+        window_counts = counts[positions] - counts[lower]
+        self.atr[start:end] = np.where(window_counts == self.window,
+                                       (sums[positions] - sums[lower]) / self.window, np.nan)
+
+    def _wilder(self, start: int, end: int):
+        """ATR_t = (ATR_t-1 * (n - 1) + TR_t) / n, seeded with the first full-window mean"""
+        n = self.window
+        for p in range(start, end):
+            previous = self.atr[p - 1] if p > 0 else math.nan
+            tr = self.tr[p]
+            if math.isnan(previous):
+                seed = self.tr[p - n + 1:p + 1] if p >= n - 1 else None
+                self.atr[p] = seed.mean() if seed is not None and not np.isnan(seed).any() else math.nan
+            elif math.isnan(tr):
+                self.atr[p] = previous
+            else:
+                self.atr[p] = (previous * (n - 1) + tr) / n
+
+    def view(self) -> ATRSeries:
+        index = self.index[:self.size]
+        values = self.atr[:self.size]
+        index.flags.writeable = False
+        values.flags.writeable = False
+        return ATRSeries(index=index, values=values)
+
+
+class ATRStateCache(BarStateCache):
+    """ATR states shared across requests, keyed by (ticker, window, method)"""
+
+    def get(self, ticker: str, history: pd.DataFrame, window: int, method: Optional[str] = None) -> ATRSeries:
+        """ATR series of `history`, brought up to date from the stored state"""
+        method = method or ATR_METHOD
+        state, lock = self.state((ticker, window, method), lambda: ATRState(window, method))
+        with lock:
+            return state.update(history)
+
+
+atr_states = ATRStateCache(MAX_ATR_STATES)
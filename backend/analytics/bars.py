@@ -0,0 +1,142 @@
+"""
+Per-ticker bar state
+Compact growable per-bar arrays kept between requests, lined up against each fresh
+history so only bars that are new (or were revised) get recomputed
+"""
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Rebuild generations are unique across every state, so a dependent state can tell a
+# rebuilt (or evicted and recreated) state apart from the one it last synced with
+_generations = itertools.count(1)
+
+
+def bar_dates(values) -> np.ndarray:
+    return np.asarray(values).astype("datetime64[ns]")
+
+
+class BarState(ABC):
+    """
+    Bar dates and closes plus the per-bar arrays named in `columns`, filled by _extend().
+
+    update() matches the history against the stored bars and only extends what is new.
+    The last stored bar is always recomputed since it may have been an intraday bar that
+    has since been revised. A history that no longer lines up with the stored bars (a
+    dividend re-adjustment, a deeper fetch) rebuilds the arrays from scratch. Either way
+    the results are written to fresh buffers (the kept bars are copied over first), so
+    views handed out earlier, which are read outside the lock, keep the bars they were
+    built on.
+    """
+
+    columns: Tuple[str, ...] = ()
+
+    def __init__(self):
+        self.size = 0
+        self.generation = next(_generations)
+        # First position recomputed by the last update()
+        self.changed_from = 0
+        self._allocate(0)
+
+    def _allocate(self, capacity: int):
+        self.index = np.empty(capacity, dtype="datetime64[ns]")
+        self.close = np.empty(capacity)
+        for name in self.columns:
+            setattr(self, name, np.empty(capacity))
+
+    def _reserve(self, size: int, copy: bool = False):
+        """Room for `size` bars; with copy, the stored bars move to fresh buffers even if they fit"""
+        capacity = self.index.size
+        if size <= capacity and not copy:
+            return
+        names = ("index", "close") + self.columns
+        old = [getattr(self, name) for name in names]
+        self._allocate(max(size, 2 * capacity, 256) if size > capacity else capacity)
+        for name, previous in zip(names, old):
+            getattr(self, name)[:self.size] = previous[:self.size]
+
+    def _resume_point(self, index: np.ndarray, close: np.ndarray) -> Optional[Tuple[int, int]]:
+        """(state position of the first history bar, first history bar to compute), or None to rebuild"""
+        if self.size == 0 or index.size == 0:
+            return None
+        offset = int(np.searchsorted(self.index[:self.size], index[0]))
+        if offset >= self.size or self.index[offset] != index[0]:
+            return None  # the history starts before (or outside) the stored bars
+        overlap = self.size - offset
+        if overlap > index.size:
+            return None  # the stored bars run past this history
+        resume = overlap - 1
+        if resume > 0:
+            # The last bar kept must be unchanged, or everything after it would be stale
+            checkpoint = offset + resume - 1
+            if self.index[checkpoint] != index[resume - 1] or self.close[checkpoint] != close[resume - 1]:
+                return None
+        return offset, resume
+
+    def update(self, history: pd.DataFrame):
+        index = bar_dates(history.index.values)
+        close = history["Close"].to_numpy(dtype=float)
+
+        resume_point = self._resume_point(index, close)
+        if resume_point is None:
+            offset, resume = 0, 0
+            self.size = 0
+            self.generation = next(_generations)
+            self._allocate(index.size)
+        else:
+            offset, resume = resume_point
+            self.size = offset + resume
+        start, end = self.size, offset + index.size
+        # Resuming rewrites the last stored bar, which earlier views still hold
+        self._reserve(end, copy=resume_point is not None)
+
+        self.index[start:end] = index[resume:]
+        self.close[start:end] = close[resume:]
+        self._extend(history.iloc[resume:], start, end)
+        self.size = end
+        self.changed_from = start
+        return self.view()
+
+    def prev_close(self, start: int, end: int) -> np.ndarray:
+        """Close of the bar before each of positions start..end-1 (NaN before the first bar)"""
+        if start > 0:
+            return self.close[start - 1:end - 1]
+        return np.concatenate(([np.nan], self.close[:end - 1]))
+
+    @abstractmethod
+    def _extend(self, bars: pd.DataFrame, start: int, end: int):
+        """Fill the per-bar columns for positions start..end-1, from `bars` (one row per position)"""
+
+    @abstractmethod
+    def view(self):
+        """Read-only arrays of the stored bars"""
+
+
+class BarStateCache:
+    """Bar states shared across requests, least recently used evicted past max_entries"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._states: "OrderedDict[Hashable, BarState]" = OrderedDict()
+        self._locks: Dict[Hashable, threading.RLock] = {}
+        self._lock = threading.Lock()
+
+    def state(self, key: Hashable, factory: Callable[[], BarState]) -> Tuple[BarState, threading.RLock]:
+        """The state for key (created on first use) and the lock to hold while updating or reading it"""
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = factory()
+                self._locks[key] = threading.RLock()
+            self._states.move_to_end(key)
+            lock = self._locks[key]
+            while len(self._states) > self.max_entries:
+                evicted, _ = self._states.popitem(last=False)
+                self._locks.pop(evicted, None)
+        return state, lock
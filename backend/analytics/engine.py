@@ -0,0 +1,196 @@
+"""
+Vectorized portfolio analytics engine
+Builds one price/returns matrix (days x tickers) per request and computes every
+per-ticker metric with column-wise array operations instead of one pass per row
+"""
+import math
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from backend.analytics.atr import ATRSeries, atr_states
+from backend.analytics.moments import MomentsView, moment_states
+from backend.analytics.options import atm_implied_vols
+from backend.analytics.var import RiskTable, portfolio_risk_table, portfolio_var, risk_table, var_quantiles
+
+TRADING_DAYS = 252
+
+
+def aligned_log_returns(closes: pd.DataFrame) -> np.ndarray:
+    """
+    Date-aligned log returns. A ticker missing a date that others traded gets NaN there,
+    and its next return is measured from its last available close.
+    """
+    values = closes.to_numpy(dtype=float)
+    prev = closes.ffill().shift(1).to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = np.log(values / prev)
+    return returns[1:]
+
+
+class PortfolioAnalytics:
+    """Per-ticker analytics for one request; every array is indexed by column"""
+
+    def __init__(self, tickers: List[str], atr: Dict[str, ATRSeries], current_price: np.ndarray,
+                 returns: np.ndarray, return_counts: np.ndarray, mean: np.ndarray,
+                 std: np.ndarray, beta: np.ndarray, var_quantile: np.ndarray, iv: np.ndarray,
+                 market_annual_return: Optional[float], risk: Optional[RiskTable] = None,
+                 rolling_betas: Optional[Dict[str, np.ndarray]] = None):
+        self.tickers = tickers
+        self.columns = {ticker: j for j, ticker in enumerate(tickers)}
+        self.atr = atr
+        self.current_price = current_price
+        self.returns = returns
+        self.return_counts = return_counts
+        self.mean = mean
+        self.std = std
+        self.beta = beta
+        self.var_quantile = var_quantile
+        self.iv = iv
+        self.market_annual_return = market_annual_return
+        self.risk = risk
+        self.rolling_betas = rolling_betas or {}
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.columns
+
+    @staticmethod
+    def _value(array: np.ndarray, j: int, digits: int) -> Optional[float]:
+        value = array[j]
+        return None if np.isnan(value) else float(round(value, digits))
+
+    def metrics(self, ticker: str) -> Dict[str, Optional[float]]:
+        j = self.columns[ticker]
+        return {
+            "current_price": float(round(self.current_price[j], 4)),
+            "atr": self.atr[ticker].latest,
+            "beta": self._value(self.beta, j, 4),
+            "var_quantile": None if np.isnan(self.var_quantile[j]) else float(self.var_quantile[j]),
+            "iv": self._value(self.iv, j, 4),
+            "risk": list(self.risk.levels(j)) if self.risk is not None and self.return_counts[j] >= 2 else None,
+            **{name: self._value(betas, j, 4) for name, betas in self.rolling_betas.items()},
+        }
+
+    def held(self, values: Dict[str, float]) -> List[str]:
+        """
+        Tickers of values with a position and enough returns, in panel order: simulated
+        draws are assigned by position, so the result must not depend on the order of values
+        """
+        return [t for t in self.tickers if values.get(t) and self.return_counts[self.columns[t]] >= 2]
+
+    def portfolio_var(self, values: Dict[str, float], method: str, simulations: int,
+                      confidence: float) -> Optional[Tuple[float, Dict[str, float]]]:
+        """
+        Correlated VaR of the whole book from one simulation over the returns panel.
+        values maps ticker -> total position value; returns (VaR, contribution per ticker).
+        """
+        held = self.held(values)
+        if not held:
+            return None
+        columns = [self.columns[t] for t in held]
+        result = portfolio_var(np.array([values[t] for t in held]), self.returns[:, columns], method,
+                               simulations, confidence)
+        return result.var, dict(zip(held, (float(c) for c in result.contributions)))
+
+    def portfolio_risk(self, values: Dict[str, float], method: str, simulations: int,
+                       confidences: Sequence[float], horizons: Sequence[int]) -> Optional[RiskTable]:
+        """Book-level VaR / Expected Shortfall table (P&L amounts) from the same returns panel"""
+        held = self.held(values)
+        if not held:
+            return None
+        columns = [self.columns[t] for t in held]
+        return portfolio_risk_table(np.array([values[t] for t in held]), self.returns[:, columns], method,
+                                    simulations, confidences, horizons)
+
+    def atr_at(self, ticker: str, dt: pd.Timestamp) -> Optional[float]:
+        """ATR on the last bar on or before dt"""
+        return self.atr[ticker].at(dt)
+
+
+def compute_portfolio_analytics(histories: Dict[str, pd.DataFrame], market_proxy: str, window_start: pd.Timestamp,
+                                atr_window: int, atr_method: Optional[str], var_method: str, var_simulations: int,
+                                var_confidence: float, var_confidences: Optional[Sequence[float]] = None,
+                                var_horizons: Optional[Sequence[int]] = None,
+                                beta_windows: Optional[Dict[str, int]] = None, risk_free_rate: float = 0.0,
+                                iv_tenor_days: int = 30) -> PortfolioAnalytics:
+    """
+    One matrix pass over every ticker of a request. ATR and the return moments come from
+    each ticker's incremental state over its loaded history (deep histories included, for
+    entry-date lookups); mean, volatility, beta, VaR and IV are over the window starting at
+    window_start, VaR from the date-aligned returns panel. With var_confidences /
+    var_horizons, a VaR / Expected Shortfall table is added per ticker; beta_windows maps
+    extra beta fields to trailing windows in trading days.
+    """
+    tickers = sorted(t for t, h in histories.items() if h is not None and not h.empty)
+    atr = {t: atr_states.get(t, histories[t], atr_window, atr_method) for t in tickers}
+    current_price = np.array([histories[t]["Close"].iloc[-1] for t in tickers], dtype=float)
+
+    windows = {}
+    for t in tickers:
+        all_closes = histories[t]["Close"]
+        recent = all_closes[all_closes.index >= window_start]
+        # A ticker that stopped trading before the window still gets its last bars
+        windows[t] = recent if not recent.empty else all_closes
+    closes = pd.concat(windows, axis=1).sort_index() if tickers else pd.DataFrame()
+    returns = aligned_log_returns(closes) if tickers else np.empty((0, 0))
+
+    return_counts = (~np.isnan(returns)).sum(axis=0)
+
+    # The market state is brought up to date first, since every ticker is paired against it
+    market = market_proxy if market_proxy in tickers else None
+    moments: Dict[str, MomentsView] = {}
+    if market:
+        moments[market] = moment_states.get(market, histories[market], market)
+    for t in tickers:
+        if t != market:
+            moments[t] = moment_states.get(t, histories[t], market)
+
+    def betas(first_position: Callable[[MomentsView], int]) -> np.ndarray:
+        values = [moments[t].beta(first_position(moments[t])) for t in tickers]
+        return np.array([np.nan if b is None else b for b in values], dtype=float)
+
+    stats = [moments[t].stats(moments[t].first_position(window_start)) for t in tickers]
+    mean = np.array([s.mean for s in stats], dtype=float)
+    std = np.array([s.std for s in stats], dtype=float)
+    beta = np.full(len(tickers), np.nan)
+    rolling_betas = {}
+    market_annual_return = None
+    if market:
+        beta = betas(lambda m: m.first_position(window_start))
+        for name, days in (beta_windows or {}).items():
+            rolling_betas[name] = betas(lambda m: m.trailing_position(days))
+        market_stats = stats[tickers.index(market)]
+        if market_stats.count > 0:
+            market_annual_return = float(market_stats.mean * TRADING_DAYS)
+
+    var_quantile = np.full(len(tickers), np.nan)
+    has_var = return_counts >= 2
+    if has_var.any():
+        var_quantile[has_var] = var_quantiles(mean[has_var], std[has_var], var_method, var_simulations,
+                                              var_confidence, returns[:, has_var])
+
+    risk = None
+    if var_confidences and var_horizons:
+        risk = risk_table(np.nan_to_num(mean), np.nan_to_num(std), var_method, var_simulations,
+                          var_confidences, var_horizons, returns)
+
+    # One masked Newton solve for every ticker at once
+    iv = atm_implied_vols(current_price, risk_free_rate, iv_tenor_days, np.nan_to_num(std * math.sqrt(TRADING_DAYS)))
+    iv = np.where(return_counts >= 5, iv, np.nan)
+
+    return PortfolioAnalytics(
+        tickers=tickers,
+        atr=atr,
+        current_price=current_price,
+        returns=returns,
+        return_counts=return_counts,
+        mean=mean,
+        std=std,
+        beta=beta,
+        var_quantile=var_quantile,
+        iv=iv,
+        market_annual_return=market_annual_return,
+        risk=risk,
+        rolling_betas=rolling_betas,
+    )
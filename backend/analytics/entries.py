@@ -0,0 +1,113 @@
+"""
+Entry-date index
+The purchase date inferred from price_bought and the ATR on that date, per (ticker, inputs)
+key. Found once with a reverse scan of the bars, then kept in process and persisted with
+the position, so later recalcs skip the scan entirely.
+"""
+import math
+import threading
+from typing import Dict, Iterable, NamedTuple, Optional
+
+import numpy as np
+
+from backend.market.cache import TTLCache
+
+ENTRY_SCAN_CHUNK = 256
+MAX_ENTRY_POINTS = 4096
+
+
+class EntryPoint(NamedTuple):
+    date: Optional[str]  # YYYY-MM-DD
+    atr: Optional[float]
+
+
+def entry_key(price_bought: float, date_bought: Optional[str], atr_window: int, atr_method: str) -> str:
+    """Fingerprint of everything an entry point depends on, stored next to it so stale values are ignored"""
+    return f"{float(price_bought)!r}|{date_bought or ''}|{atr_method}:{atr_window}"
+
+
+def last_bar_containing(low: np.ndarray, high: np.ndarray, price: float, chunk: int = ENTRY_SCAN_CHUNK) -> int:
+    """
+    Position of the most recent bar whose Low..High range contains price, or -1.
+    Bars are scanned newest first in chunks, stopping at the first chunk with a match,
+    since recent purchases are the common case.
+    """
+    end = low.size
+    while end > 0:
+        start = max(end - chunk, 0)
+        hits = np.flatnonzero((low[start:end] <= price) & (high[start:end] >= price))
+        if hits.size:
+            return start + int(hits[-1])
+        end = start
+    return -1
+
+
+class EntryIndex:
+    """
+    Entry points by (ticker, entry_key); an entry point never changes for the same key.
+    Also tracks the key of each saved position (ticker is the positions primary key) and
+    the key of the entry point last stored with it, so only saved positions are written
+    back, once per change of inputs.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRY_POINTS):
+        self._points = TTLCache(ttl_seconds=math.inf, max_entries=max_entries)
+        self._saved: Dict[str, str] = {}
+        self._stored: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, ticker: str, key: str) -> Optional[EntryPoint]:
+        return self._points.get((ticker, key))
+
+    def set(self, ticker: str, key: str, point: EntryPoint):
+        self._points.set((ticker, key), point)
+
+    def seed(self, positions: Iterable[dict], atr_window: int, atr_method: str) -> int:
+        """
+        Take the saved positions as the current set, and load the entry points persisted
+        with them, skipping any computed from other inputs
+        """
+        saved: Dict[str, str] = {}
+        stored: Dict[str, str] = {}
+        loaded = 0
+        for position in positions:
+            ticker = (position.get("ticker") or "").strip().upper()
+            if not ticker or position.get("price_bought") is None:
+                continue
+            key = entry_key(position["price_bought"], position.get("date_bought"), atr_window, atr_method)
+            saved[ticker] = key
+            if position.get("entry_key"):
+                stored[ticker] = position["entry_key"]
+            if position.get("entry_key") == key:
+                self.set(ticker, key, EntryPoint(position.get("entry_date"), position.get("entry_atr")))
+                loaded += 1
+        with self._lock:
+            self._saved = saved
+            self._stored = stored
+        return loaded
+
+    def mark_saved(self, ticker: str, key: str):
+        with self._lock:
+            self._saved[ticker] = key
+
+    def forget_saved(self, ticker: str):
+        with self._lock:
+            self._saved.pop(ticker, None)
+            self._stored.pop(ticker, None)
+
+    def claim_write(self, ticker: str, key: str) -> bool:
+        """True (once) when the entry point belongs to a saved position and is not the one stored with it"""
+        with self._lock:
+            if self._saved.get(ticker) != key or self._stored.get(ticker) == key:
+                return False
+            self._stored[ticker] = key
+            return True
+
+    def release_write(self, ticker: str, key: str):
+        """A claimed write failed: let a later lookup try again"""
+        with self._lock:
+            if self._stored.get(ticker) == key:
+                del self._stored[ticker]
+
+
+entry_index = EntryIndex()
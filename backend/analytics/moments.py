@@ -0,0 +1,190 @@
+"""
+Running return moments
+Per-ticker prefix sums of daily log returns, and of their products with the market proxy's
+returns on the same dates, kept between requests. Mean, variance, covariance and beta over
+any trailing window are then differences of two prefix sums instead of a pass over history.
+"""
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from backend.analytics.bars import BarState, BarStateCache, bar_dates
+
+MAX_MOMENT_STATES = 1024
+
+
+class ReturnStats(NamedTuple):
+    count: int
+    mean: float
+    std: float  # population standard deviation, like np.std
+
+
+def _window_sum(prefix: np.ndarray, first: int) -> float:
+    """Sum of the summed values at positions first..end, from an inclusive prefix-sum array"""
+    if not prefix.size:
+        return 0.0
+    return float(prefix[-1] - (prefix[first - 1] if first > 0 else 0.0))
+
+
+class MomentsView(NamedTuple):
+    """
+    Read-only prefix sums of one ticker. Position k holds the return from bar k-1 to bar k
+    (NaN at the first bar). Sums are of values shifted by a constant near the data (the
+    first return), which keeps the differences of large sums from cancelling out.
+    """
+    index: np.ndarray    # bar dates
+    returns: np.ndarray  # log return per position
+    shift: float
+    market_shift: float
+    n: np.ndarray        # returns so far
+    sx: np.ndarray       # sum of (x - shift)
+    sxx: np.ndarray      # sum of (x - shift)^2
+    pn: np.ndarray       # returns paired with a market return on the same date
+    px: np.ndarray       # paired sums of (x - shift), (y - market_shift), (y - market_shift)^2
+    py: np.ndarray       # and (x - shift) * (y - market_shift)
+    pyy: np.ndarray
+    pxy: np.ndarray
+
+    def first_position(self, start: pd.Timestamp) -> int:
+        """
+        First return inside a window starting at `start`: the one after the first bar on or
+        after start. A ticker that stopped trading before the window keeps all its returns.
+        """
+        bar = int(np.searchsorted(self.index, bar_dates(pd.Timestamp(start).to_datetime64())))
+        return bar + 1 if bar < self.index.size else 0
+
+    def trailing_position(self, returns: int) -> int:
+        """First position of the last `returns` trading days"""
+        return max(self.index.size - returns, 0)
+
+    def window_returns(self, first: int = 0) -> np.ndarray:
+        returns = self.returns[first:]
+        return returns[~np.isnan(returns)]
+
+    def stats(self, first: int = 0) -> ReturnStats:
+        count = int(_window_sum(self.n, first))
+        if count == 0:
+            return ReturnStats(count=0, mean=float("nan"), std=float("nan"))
+        total = _window_sum(self.sx, first)
+        variance = max(_window_sum(self.sxx, first) - total * total / count, 0.0) / count
+        return ReturnStats(count=count, mean=self.shift + total / count, std=float(np.sqrt(variance)))
+
+    def beta(self, first: int = 0) -> Optional[float]:
+        """
+        Beta against the market over the dates both have returns: sample covariance
+        over population market variance, the convention the app has always used.
+        """
+        count = int(_window_sum(self.pn, first))
+        if count < 2:
+            return None
+        sum_x = _window_sum(self.px, first)
+        sum_y = _window_sum(self.py, first)
+        covariance = (_window_sum(self.pxy, first) - sum_x * sum_y / count) / (count - 1)
+        variance = (_window_sum(self.pyy, first) - sum_y * sum_y / count) / count
+        if variance <= 0:
+            return None
+        return float(covariance / variance)
+
+
+class ReturnMomentsState(BarState):
+    """Return prefix sums of one ticker, optionally paired with the market proxy's state"""
+
+    columns = ("ret", "n", "sx", "sxx", "pn", "px", "py", "pyy", "pxy")
+
+    def __init__(self):
+        self.shift = 0.0
+        self.market_shift = 0.0
+        # (generation, size) of the market state at the last pairing
+        self._market_sync = None
+        super().__init__()
+
+    def _extend(self, bars: pd.DataFrame, start: int, end: int):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            returns = np.log(self.close[start:end] / self.prev_close(start, end))
+        self.ret[start:end] = returns
+        if start == 0:
+            finite = returns[np.isfinite(returns)]
+            self.shift = float(finite[0]) if finite.size else 0.0
+        valid = np.isfinite(returns)
+        dx = np.where(valid, returns - self.shift, 0.0)
+        self._accumulate(start, end, (self.n, valid), (self.sx, dx), (self.sxx, dx * dx))
+
+    @staticmethod
+    def _accumulate(start: int, end: int, *pairs):
+        """Continue each prefix-sum array over start..end-1 with the given values"""
+        for prefix, values in pairs:
+            base = prefix[start - 1] if start > 0 else 0.0
+            prefix[start:end] = base + np.cumsum(values)
+
+    def pair(self, market: Optional["ReturnMomentsState"]):
+        """
+        Bring the paired sums up to date. Only positions from the first one that changed
+        here, or from the market's last synced (possibly revised) bar, are recomputed;
+        a rebuilt market state re-pairs everything.
+        """
+        first = self.changed_from
+        if market is None:
+            self._market_sync = None
+            first = 0
+            y = np.full(self.size, np.nan)
+        else:
+            synced = self._market_sync
+            if synced is None or synced[0] != market.generation:
+                first = 0
+                self.market_shift = market.shift
+            elif synced[1] > 0:
+                market_changed = market.index[synced[1] - 1]
+                first = min(first, int(np.searchsorted(self.index[:self.size], market_changed)))
+            self._market_sync = (market.generation, market.size)
+
+            # The market's return on each of this ticker's return dates, NaN where it has none
+            dates = self.index[first:self.size]
+            y = np.full(dates.size, np.nan)
+            if market.size:
+                market_dates = market.index[:market.size]
+                positions = np.minimum(np.searchsorted(market_dates, dates), market.size - 1)
+                matched = market_dates[positions] == dates
+                y[matched] = market.ret[positions[matched]]
+
+        x = self.ret[first:self.size]
+        paired = np.isfinite(x) & np.isfinite(y)
+        dx = np.where(paired, x - self.shift, 0.0)
+        dy = np.where(paired, y - self.market_shift, 0.0)
+        self._accumulate(first, self.size, (self.pn, paired), (self.px, dx), (self.py, dy),
+                         (self.pyy, dy * dy), (self.pxy, dx * dy))
+
+    def view(self) -> MomentsView:
+        arrays = {}
+        for name in ("index", "ret", "n", "sx", "sxx", "pn", "px", "py", "pyy", "pxy"):
+            array = getattr(self, name)[:self.size]
+            array.flags.writeable = False
+            arrays[name] = array
+        return MomentsView(
+            index=arrays["index"], returns=arrays["ret"], shift=self.shift, market_shift=self.market_shift,
+            n=arrays["n"], sx=arrays["sx"], sxx=arrays["sxx"], pn=arrays["pn"], px=arrays["px"],
+            py=arrays["py"], pyy=arrays["pyy"], pxy=arrays["pxy"],
+        )
+
+
+class MomentStateCache(BarStateCache):
+    """Return-moment states shared across requests, keyed by ticker"""
+
+    def get(self, ticker: str, history: pd.DataFrame, market: Optional[str] = None) -> MomentsView:
+        """
+        Moments of `history`, paired with the market ticker's state when given. Update the
+        market's own state first: pairing reads whatever it holds at that moment.
+        """
+        state, lock = self.state(ticker, ReturnMomentsState)
+        market_state, market_lock = self.state(market, ReturnMomentsState) if market else (None, None)
+        with lock:
+            state.update(history)
+            if market_state is None:
+                state.pair(None)
+            else:
+                with market_lock:
+                    state.pair(market_state)
+            return state.view()
+
+
+moment_states = MomentStateCache(MAX_MOMENT_STATES)
@@ -0,0 +1,144 @@
+"""
+Black-Scholes pricing and implied volatility on arrays
+Every function broadcasts over its inputs, so one call prices a whole portfolio (or a
+tickers x strikes x tenors grid) instead of one scalar loop per position
+"""
+import math
+from typing import Tuple
+
+import numpy as np
+
+IV_MAX_ITERATIONS = 8
+IV_TOLERANCE = 1e-10
+MIN_VEGA = 1e-8
+# Newton steps are capped here: far from the money a small vega can throw sigma way out
+MAX_VOL = 5.0
+# Bracket of the bisection fallback, and enough halvings to shrink it below IV_TOLERANCE
+MIN_VOL = 1e-4
+IV_BISECTION_ITERATIONS = math.ceil(math.log2((MAX_VOL - MIN_VOL) / IV_TOLERANCE))
+
+
+def norm_pdf(x: np.ndarray) -> np.ndarray:
+    return np.exp(-0.5 * np.square(x)) / math.sqrt(2 * math.pi)
+
+
+def norm_cdf(x: np.ndarray) -> np.ndarray:
+    """Standard normal CDF (Abramowitz & Stegun 26.2.17, |error| < 7.5e-8): numpy has no erf"""
+    x = np.asarray(x, dtype=float)
+    z = np.abs(x)
+    t = 1.0 / (1.0 + 0.2316419 * z)
+    poly = t * (0.319381530 + t * (-0.356563782 + t * (1.781477937 + t * (-1.821255978 + t * 1.330274429))))
+    upper_tail = norm_pdf(z) * poly
+    return np.where(x >= 0, 1.0 - upper_tail, upper_tail)
+
+
+def _d1_d2(s, k, r, sigma, t) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """d1, d2 and the mask of inputs Black-Scholes is defined for"""
+    valid = (s > 0) & (k > 0) & (sigma > 0) & (t > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vol_sqrt_t = sigma * np.sqrt(t)
+        d1 = (np.log(s / k) + (r + 0.5 * np.square(sigma)) * t) / vol_sqrt_t
+    return d1, d1 - vol_sqrt_t, valid
+
+
+def black_scholes_call_price(s, k, r, sigma, t) -> np.ndarray:
+    """European call price; 0 wherever spot, strike, volatility or tenor is not positive"""
+    d1, d2, valid = _d1_d2(s, k, r, sigma, t)
+    with np.errstate(invalid="ignore", over="ignore"):
+        price = s * norm_cdf(d1) - k * np.exp(-r * t) * norm_cdf(d2)
+    return np.where(valid, price, 0.0)
+
+
+def black_scholes_vega(s, k, r, sigma, t) -> np.ndarray:
+    """dPrice/dSigma of the call (same for the put); 0 where the price is undefined"""
+    d1, _, valid = _d1_d2(s, k, r, sigma, t)
+    with np.errstate(invalid="ignore"):
+        vega = s * np.sqrt(t) * norm_pdf(d1)
+    return np.where(valid, vega, 0.0)
+
+
+def initial_vol_guess(s, k, r, t) -> np.ndarray:
+    """Manaster-Koehler starting point, from which Newton converges monotonically for calls"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        guess = np.sqrt(2 * np.abs(np.log(s / k) + r * t) / t)
+    return np.clip(np.nan_to_num(guess, nan=0.3), 0.05, MAX_VOL)
+
+
+def implied_vol(price, s, k, r, t, initial=None, max_iterations: int = IV_MAX_ITERATIONS) -> np.ndarray:
+    """
+    Implied volatility of every element at once, NaN where it cannot be recovered.
+    Newton iteration first: each step only reprices the elements still iterating, and an
+    element is done once its step is below IV_TOLERANCE. Elements Newton leaves behind
+    (out of iterations, vanishing vega, a step to sigma <= 0) are bisected on
+    [MIN_VOL, MAX_VOL]. A price outside that bracket, or one so close to intrinsic or zero
+    that sigma barely moves it (vega <= MIN_VEGA at the solution), gives NaN.
+    Without `initial`, Newton starts from initial_vol_guess.
+    """
+    if initial is None:
+        initial = initial_vol_guess(*np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (s, k, r, t))))
+    price, s, k, r, t, initial = (np.array(a, dtype=float) for a in np.broadcast_arrays(price, s, k, r, t, initial))
+    sigma = initial.copy()
+    active = np.array((sigma > 0) & (price > 0))
+    converged = np.zeros_like(active)
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        a = active
+        model = black_scholes_call_price(s[a], k[a], r[a], sigma[a], t[a])
+        vega = black_scholes_vega(s[a], k[a], r[a], sigma[a], t[a])
+        stalled = (model <= 0) | (vega <= MIN_VEGA)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = np.where(stalled, 0.0, (model - price[a]) / vega)
+        updated = sigma[a] - step
+        failed = ~stalled & (updated <= 0)
+        sigma[a] = np.where(failed, initial[a], np.minimum(updated, MAX_VOL))
+        done = ~stalled & ~failed & (np.abs(step) <= IV_TOLERANCE)
+        converged[a] = done
+        active[a] = ~stalled & ~failed & ~done
+
+    result = np.where(converged, sigma, np.nan)
+    pending = ~converged & (price > 0) & (s > 0) & (k > 0) & (t > 0)
+    if pending.any():
+        result[pending] = _bisect_vol(price[pending], s[pending], k[pending], r[pending], t[pending])
+    return result
+
+
+def _bisect_vol(price, s, k, r, t) -> np.ndarray:
+    """Bisection on [MIN_VOL, MAX_VOL] (the call price rises with sigma), NaN where sigma is not identifiable"""
+    low = np.full(price.shape, MIN_VOL)
+    high = np.full(price.shape, MAX_VOL)
+    bracketed = ((black_scholes_call_price(s, k, r, low, t) <= price)
+                 & (price <= black_scholes_call_price(s, k, r, high, t)))
+    for _ in range(IV_BISECTION_ITERATIONS):
+        mid = 0.5 * (low + high)
+        above = black_scholes_call_price(s, k, r, mid, t) > price
+        high = np.where(above, mid, high)
+        low = np.where(above, low, mid)
+    sigma = 0.5 * (low + high)
+    identifiable = bracketed & (black_scholes_vega(s, k, r, sigma, t) > MIN_VEGA)
+    return np.where(identifiable, sigma, np.nan)
+
+
+def atm_implied_vols(spot, r: float, tenor_days: int, realized_vol) -> np.ndarray:
+    """
+    The app's IV estimate for each position: the implied volatility of an ATM call priced
+    off its annualized realized volatility. NaN where spot or volatility is not positive.
+    """
+    spot, realized_vol = np.broadcast_arrays(np.asarray(spot, dtype=float), np.asarray(realized_vol, dtype=float))
+    t = tenor_days / 365.0
+    target = black_scholes_call_price(spot, spot, r, realized_vol, t)
+    sigma = implied_vol(target, spot, spot, r, t, realized_vol)
+    return np.where((spot > 0) & (realized_vol > 0) & (target > 0), np.maximum(sigma, 0.0), np.nan)
+
+
+def option_grid(spot, sigma, r: float, moneyness, tenor_days) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Call prices and vegas for every (ticker, strike, tenor) in one broadcast:
+    spot and sigma per ticker, strikes as multiples of spot, tenors in calendar days.
+    Returns two (tickers x strikes x tenors) arrays.
+    """
+    s = np.asarray(spot, dtype=float)[:, None, None]
+    vol = np.asarray(sigma, dtype=float)[:, None, None]
+    k = s * np.asarray(moneyness, dtype=float)[None, :, None]
+    t = np.asarray(tenor_days, dtype=float)[None, None, :] / 365.0
+    return black_scholes_call_price(s, k, r, vol, t), black_scholes_vega(s, k, r, vol, t)
@@ -0,0 +1,164 @@
+"""
+Standard-normal scenario draws for VaR simulation
+Supports antithetic variates and low-discrepancy (Halton / Sobol) sequences from a seedable
+generator; deterministic draw sets are generated once and reused across rows and requests
+"""
+import math
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+SAMPLERS = ("pseudo", "antithetic", "halton", "sobol")
+
+# "pseudo" draws fresh numbers on every call (the previous behaviour); the other samplers
+# give the same draw set for the same (simulations, dims, seed), so VaR no longer flickers.
+# Halton points are digit-scrambled: unscrambled, the large prime bases used for a book of a
+# few hundred holdings are strongly correlated with each other, which skews the per-position
+# tail contributions.
+VAR_SAMPLER = os.getenv("VAR_SAMPLER", "halton").strip().lower()
+if VAR_SAMPLER not in SAMPLERS:
+    print(f"⚠️ Unknown VAR_SAMPLER '{VAR_SAMPLER}', using halton")
+    VAR_SAMPLER = "halton"
+# Seed for reproducible draws across processes; unset means one random seed per process
+VAR_SEED = int(os.getenv("VAR_SEED")) if os.getenv("VAR_SEED", "").strip() else None
+
+MAX_CACHED_DRAW_SETS = 32
+
+_sobol_warned = False
+
+
+def _first_primes(count: int) -> np.ndarray:
+    limit = max(16, int(count * (math.log(count + 1) + math.log(math.log(count + 3)))) + 10)
+    sieve = np.ones(limit + 1, dtype=bool)
+    sieve[:2] = False
+    for i in range(2, int(limit ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = False
+    return np.flatnonzero(sieve)[:count]
+
+
+def halton_points(n: int, dims: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    (n x dims) scrambled Halton points in (0, 1), one prime base per dimension. Every digit
+    position of every dimension goes through its own random permutation of the base's
+    digits (random-permutation scrambling), which removes the correlation between
+    dimensions with large bases. Digits are generated to about 40 bits of resolution.
+    """
+    points = np.empty((n, dims))
+    indices = np.arange(1, n + 1)
+    for d, base in enumerate(_first_primes(dims)):
+        levels = math.ceil(math.log(n + 1) / math.log(base)) + math.ceil(40 / math.log2(base))
+        remaining = indices.copy()
+        value = np.zeros(n)
+        fraction = 1.0 / base
+        for _ in range(levels):
+            remaining, digit = np.divmod(remaining, base)
+            value += rng.permutation(base)[digit] * fraction
+            fraction /= base
+        points[:, d] = value
+    # A point can land on exactly 0; keep every point inside the (0, 1) strata of the set
+    return np.clip(points, 0.5 / n, 1 - 0.5 / n)
+
+
+def sobol_points(n: int, dims: int, seed: Optional[int]) -> Optional[np.ndarray]:
+    """Scrambled Sobol points, or None when scipy (an optional dependency) is not installed"""
+    try:
+        from scipy.stats import qmc
+    except ImportError:
+        global _sobol_warned
+        if not _sobol_warned:
+            print("⚠️ scipy not installed, using Halton instead of Sobol draws")
+            _sobol_warned = True
+        return None
+    with warnings.catch_warnings():
+        # Sobol balance properties hold for powers of two; other sizes are still fine for VaR
+        warnings.simplefilter("ignore")
+        return qmc.Sobol(d=dims, scramble=True, seed=seed).random(n)
+
+
+def inverse_normal_cdf(p: np.ndarray) -> np.ndarray:
+    """Vectorized standard normal quantile (Acklam's rational approximation, |rel err| < 1.2e-9)"""
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00]
+    p = np.clip(p, 1e-300, 1 - 1e-16)
+    p_low = 0.02425
+    result = np.empty_like(p)
+
+    lower = p < p_low
+    upper = p > 1 - p_low
+    central = ~(lower | upper)
+
+    q = np.sqrt(-2 * np.log(p[lower]))
+    result[lower] = (((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / \
+                    ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1)
+    q = np.sqrt(-2 * np.log(1 - p[upper]))
+    result[upper] = -(((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / \
+                     ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1)
+    q = p[central] - 0.5
+    r = q * q
+    result[central] = (((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q / \
+                      (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1)
+    return result
+
+
+def generate_draws(simulations: int, dims: int, sampler: str, seed: Optional[int]) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    if sampler == "pseudo":
+        return rng.standard_normal((simulations, dims))
+    if sampler == "antithetic":
+        # Each draw is paired with its mirror image: the sample is symmetric, halving the noise
+        half = rng.standard_normal(((simulations + 1) // 2, dims))
+        return np.vstack([half, -half])[:simulations]
+    if sampler == "sobol":
+        points = sobol_points(simulations, dims, seed)
+        if points is not None:
+            return inverse_normal_cdf(points)
+    return inverse_normal_cdf(halton_points(simulations, dims, rng))
+
+
+class DrawCache:
+    """Read-only draw sets shared by every row and request, keyed by (simulations, dims, sampler, seed)"""
+
+    def __init__(self, max_entries: int = MAX_CACHED_DRAW_SETS):
+        self.max_entries = max_entries
+        self._sets: "OrderedDict[Tuple, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Fixed per process when VAR_SEED is unset, so draws are still reused between requests
+        self.process_seed = int(np.random.SeedSequence().entropy % (2 ** 32))
+
+    def get(self, simulations: int, dims: int, sampler: Optional[str] = None, seed: Optional[int] = None) -> np.ndarray:
+        sampler = sampler or VAR_SAMPLER
+        if sampler == "pseudo" and seed is None and VAR_SEED is None:
+            return np.random.standard_normal((simulations, dims))
+        seed = seed if seed is not None else (VAR_SEED if VAR_SEED is not None else self.process_seed)
+        key = (simulations, dims, sampler, seed)
+        with self._lock:
+            draws = self._sets.get(key)
+            if draws is not None:
+                self._sets.move_to_end(key)
+                return draws
+        draws = generate_draws(simulations, dims, sampler, seed)
+        draws.setflags(write=False)
+        with self._lock:
+            self._sets[key] = draws
+            while len(self._sets) > self.max_entries:
+                self._sets.popitem(last=False)
+        return draws
+
+
+draw_cache = DrawCache()
+
+
+def standard_normal_draws(simulations: int, dims: int, sampler: Optional[str] = None,
+                          seed: Optional[int] = None) -> np.ndarray:
+    """(simulations x dims) standard-normal draws from the configured sampler"""
+    return draw_cache.get(simulations, dims, sampler, seed)
@@ -0,0 +1,299 @@
+"""
+Value-at-Risk
+Per-position and correlated portfolio-level VaR over a returns panel, either simulated
+(Monte Carlo), closed-form (parametric delta-normal) or from the observed returns
+themselves (historical simulation), plus VaR / Expected Shortfall tables over several
+confidence levels and horizons
+"""
+from statistics import NormalDist
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend.analytics.scenarios import standard_normal_draws
+
+VAR_METHODS = ("monte_carlo", "parametric", "historical")
+
+
+def normal_quantile(confidence: float) -> float:
+    """Standard normal return quantile at the VaR cutoff, e.g. -1.645 for 95%"""
+    return NormalDist().inv_cdf(1 - confidence)
+
+
+def lower_quantile(simulated: np.ndarray, confidence: float) -> np.ndarray:
+    """
+    Simulated value at the VaR cutoff along axis 0. np.partition only places the cutoff
+    element, which is all a single quantile needs, instead of sorting every column.
+    """
+    cutoff = int((1 - confidence) * simulated.shape[0])
+    return np.partition(simulated, cutoff, axis=0)[cutoff]
+
+
+def tail_statistics(simulated: np.ndarray, confidences: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Value at the VaR cutoff and mean of the tail up to it (the Expected Shortfall return)
+    along axis 0, for every confidence level at once: a single np.partition places all
+    cutoffs, and everything before a cutoff is no larger than it.
+    Returns two (confidences x columns) arrays.
+    """
+    cutoffs = [int((1 - c) * simulated.shape[0]) for c in confidences]
+    partitioned = np.partition(simulated, sorted(set(cutoffs)), axis=0)
+    quantiles = np.stack([partitioned[k] for k in cutoffs])
+    shortfalls = np.stack([partitioned[:k + 1].mean(axis=0) for k in cutoffs])
+    return quantiles, shortfalls
+
+
+def historical_tail_statistics(returns: np.ndarray, confidences: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    tail_statistics over observed returns with NaN gaps: each column's cutoff is taken
+    over its own return count. One sort per column (NaN sorts last) serves every level,
+    and a running sum gives every tail mean. Returns two (confidences x columns) arrays.
+    """
+    quantiles = np.full((len(confidences), returns.shape[1]), np.nan)
+    shortfalls = np.full_like(quantiles, np.nan)
+    counts = (~np.isnan(returns)).sum(axis=0)
+    has_returns = counts > 0
+    if not has_returns.any():
+        return quantiles, shortfalls
+    ordered = np.sort(returns[:, has_returns], axis=0)
+    running = np.cumsum(np.nan_to_num(ordered), axis=0)
+    columns = np.arange(ordered.shape[1])
+    for a, confidence in enumerate(confidences):
+        cutoffs = ((1 - confidence) * counts[has_returns]).astype(int)
+        quantiles[a, has_returns] = ordered[cutoffs, columns]
+        shortfalls[a, has_returns] = running[cutoffs, columns] / (cutoffs + 1)
+    return quantiles, shortfalls
+
+
+def simulated_var_quantiles(mean: np.ndarray, std: np.ndarray, simulations: int, confidence: float) -> np.ndarray:
+    """
+    Monte Carlo VaR return quantile per column. Per-position VaR only needs each marginal,
+    so one shared column of standard-normal draws is scaled for every asset.
+    """
+    draws = standard_normal_draws(simulations, 1)
+    return lower_quantile(mean + std * draws, confidence)
+
+
+def parametric_var_quantiles(mean: np.ndarray, std: np.ndarray, confidence: float) -> np.ndarray:
+    """
+    Closed-form return quantile of the normal model the simulation draws from:
+    exact where the simulation only converges to it.
+    """
+    return mean + std * normal_quantile(confidence)
+
+
+def var_quantiles(mean: np.ndarray, std: np.ndarray, method: str, simulations: int, confidence: float,
+                  returns: Optional[np.ndarray] = None) -> np.ndarray:
+    """VaR return quantile per column; "historical" reads it off the (days x columns) returns"""
+    if method == "historical":
+        return historical_tail_statistics(returns, [confidence])[0][0]
+    if method == "parametric":
+        return parametric_var_quantiles(mean, std, confidence)
+    if method == "monte_carlo":
+        return simulated_var_quantiles(mean, std, simulations, confidence)
+    raise ValueError(f"Unknown VaR method '{method}' (expected one of {', '.join(VAR_METHODS)})")
+
+
+class RiskTable(NamedTuple):
+    """Return at the VaR cutoff and Expected Shortfall return per (confidence, horizon, column)"""
+    confidences: Tuple[float, ...]
+    horizons: Tuple[int, ...]
+    quantiles: np.ndarray   # (confidences x horizons x columns)
+    shortfalls: np.ndarray  # same shape, mean return beyond the cutoff
+
+    def levels(self, j: int):
+        """(confidence, horizon, quantile, shortfall) for column j"""
+        for a, confidence in enumerate(self.confidences):
+            for b, horizon in enumerate(self.horizons):
+                yield confidence, horizon, float(self.quantiles[a, b, j]), float(self.shortfalls[a, b, j])
+
+
+def standard_tail_statistics(method: str, simulations: int,
+                             confidences: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cutoff and tail mean of one standard-normal scenario set per confidence level.
+    Every level and horizon of a risk table is read off this one set: the h-day return of
+    the normal model is h * mean + sqrt(h) * std * Z, an increasing function of the shared
+    draw Z, so its cutoff scenario and tail are the same for every asset and horizon.
+    """
+    if method == "parametric":
+        z = np.array([normal_quantile(c) for c in confidences])
+        # Mean of a standard normal below z is -pdf(z) / P(Z < z)
+        tail = np.array([-NormalDist().pdf(q) / (1 - c) for q, c in zip(z, confidences)])
+        return z, tail
+    if method == "monte_carlo":
+        quantiles, shortfalls = tail_statistics(standard_normal_draws(simulations, 1), confidences)
+        return quantiles[:, 0], shortfalls[:, 0]
+    raise ValueError(f"Unknown VaR method '{method}' (expected one of {', '.join(VAR_METHODS)})")
+
+
+def scale_to_horizons(mean: np.ndarray, std: np.ndarray, z: np.ndarray, horizons: Sequence[int]) -> np.ndarray:
+    """
+    h * mean + sqrt(h) * std * z broadcast to (confidences x horizons x columns);
+    z is one value per confidence, or a (confidences x columns) array
+    """
+    h = np.asarray(horizons, dtype=float)[None, :, None]
+    z = np.asarray(z)
+    return h * mean + np.sqrt(h) * std * z.reshape(z.shape[0], 1, -1)
+
+
+def risk_table(mean: np.ndarray, std: np.ndarray, method: str, simulations: int,
+               confidences: Sequence[float], horizons: Sequence[int],
+               returns: Optional[np.ndarray] = None) -> RiskTable:
+    """
+    VaR and Expected Shortfall returns of every column at every (confidence, horizon).
+    Historical multi-day levels scale each column's 1-day deviation from its mean by sqrt(h).
+    """
+    if method == "historical":
+        quantiles, shortfalls = historical_tail_statistics(returns, confidences)
+        ones = np.ones_like(mean)
+        return RiskTable(
+            confidences=tuple(confidences),
+            horizons=tuple(horizons),
+            quantiles=scale_to_horizons(mean, ones, quantiles - mean, horizons),
+            shortfalls=scale_to_horizons(mean, ones, shortfalls - mean, horizons),
+        )
+    z, tail = standard_tail_statistics(method, simulations, confidences)
+    return RiskTable(
+        confidences=tuple(confidences),
+        horizons=tuple(horizons),
+        quantiles=scale_to_horizons(mean, std, z, horizons),
+        shortfalls=scale_to_horizons(mean, std, tail, horizons),
+    )
+
+
+def pairwise_covariance(returns: np.ndarray) -> np.ndarray:
+    """
+    Sample covariance of a (days x assets) panel with NaN gaps, each pair estimated
+    over the days both assets have returns (like pandas DataFrame.cov).
+    """
+    valid = ~np.isnan(returns)
+    counts = valid.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, returns, 0.0).sum(axis=0) / counts
+    centered = np.where(valid, returns - mean, 0.0)
+    pair_counts = valid.T.astype(float) @ valid.astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        covariance = (centered.T @ centered) / (pair_counts - 1)
+    return np.where(pair_counts > 1, covariance, 0.0)
+
+
+def covariance_factor(covariance: np.ndarray) -> np.ndarray:
+    """
+    Matrix L with L @ L.T == covariance. Cholesky when the estimate is positive definite,
+    otherwise an eigen factorization with negative eigenvalues clipped to zero
+    (pairwise estimates over uneven histories are not always positive semi-definite).
+    """
+    try:
+        return np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        return eigenvectors * np.sqrt(np.clip(eigenvalues, 0.0, None))
+
+
+class PortfolioVaR(NamedTuple):
+    var: float
+    contributions: np.ndarray  # per asset, sums to var
+
+
+def portfolio_var(values: np.ndarray, returns: np.ndarray, method: str, simulations: int,
+                  confidence: float) -> PortfolioVaR:
+    """
+    Correlated VaR for a whole book.
+
+    values:  position value per asset
+    returns: (days x assets) log-return panel, NaN where an asset has no return
+
+    monte_carlo: scenarios are mean + Z @ L.T with L the covariance factor, so one
+    (simulations x assets) matrix multiply replaces one simulation per position.
+    historical: the scenarios are the observed days themselves, today's holdings revalued
+    under each day's joint returns (an asset without a return that day is left unchanged).
+    For both, contributions are the average P&L of each position over the tail scenarios,
+    scaled so they add up to the portfolio VaR.
+    parametric: delta-normal VaR with Euler contributions, no simulation at all.
+    """
+    if method == "historical":
+        return tail_var(np.nan_to_num(returns) * values, confidence)
+
+    valid = ~np.isnan(returns)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, returns, 0.0).sum(axis=0) / valid.sum(axis=0)
+    covariance = pairwise_covariance(returns)
+
+    if method == "parametric":
+        exposure = covariance @ values
+        portfolio_std = float(np.sqrt(max(values @ exposure, 0.0)))
+        z = normal_quantile(confidence)
+        # P&L at the quantile, split per position: mean term plus the Euler share of the volatility term
+        quantile_pnl = values * mean + (z * values * exposure / portfolio_std if portfolio_std else 0.0)
+        total = float(quantile_pnl.sum())
+        var = abs(total)
+        contributions = quantile_pnl / total * var if total else np.zeros_like(values)
+        return PortfolioVaR(var=var, contributions=contributions)
+    if method != "monte_carlo":
+        raise ValueError(f"Unknown VaR method '{method}' (expected one of {', '.join(VAR_METHODS)})")
+
+    factor = covariance_factor(covariance)
+    draws = standard_normal_draws(simulations, values.size)
+    scenarios = mean + draws @ factor.T
+    return tail_var(scenarios * values, confidence)
+
+
+def tail_var(position_pnl: np.ndarray, confidence: float) -> PortfolioVaR:
+    """VaR and tail contributions from a (scenarios x assets) P&L matrix"""
+    if position_pnl.shape[0] == 0:
+        return PortfolioVaR(var=0.0, contributions=np.zeros(position_pnl.shape[1]))
+    portfolio_pnl = position_pnl.sum(axis=1)
+    cutoff = int((1 - confidence) * portfolio_pnl.size)
+    # argpartition puts the cutoff scenario in place with every worse scenario before it
+    order = np.argpartition(portfolio_pnl, cutoff)
+    tail = order[:cutoff + 1]
+    var = abs(float(portfolio_pnl[order[cutoff]]))
+
+    tail_pnl = position_pnl[tail].mean(axis=0)
+    tail_total = tail_pnl.sum()
+    contributions = tail_pnl / tail_total * var if tail_total else np.zeros_like(tail_pnl)
+    return PortfolioVaR(var=var, contributions=contributions)
+
+
+def portfolio_risk_table(values: np.ndarray, returns: np.ndarray, method: str, simulations: int,
+                         confidences: Sequence[float], horizons: Sequence[int]) -> RiskTable:
+    """
+    Book-level VaR and Expected Shortfall (in currency, as P&L) at every (confidence, horizon),
+    single column. The correlated scenarios of portfolio_var collapse to one P&L per scenario,
+    values @ mean + Z @ (L.T @ values), and the horizons are scaled from that one set.
+    Historical: one (days x assets) @ values product gives the book P&L of every observed day.
+    """
+    if method == "historical":
+        pnl = np.nan_to_num(returns) @ values
+        if pnl.size == 0:
+            empty = np.full((len(confidences), len(horizons), 1), np.nan)
+            return RiskTable(tuple(confidences), tuple(horizons), empty, empty)
+        pnl_mean = np.array([pnl.mean()])
+        quantiles, shortfalls = tail_statistics(pnl[:, None], confidences)
+        return RiskTable(
+            confidences=tuple(confidences),
+            horizons=tuple(horizons),
+            quantiles=scale_to_horizons(pnl_mean, np.ones(1), quantiles - pnl_mean, horizons),
+            shortfalls=scale_to_horizons(pnl_mean, np.ones(1), shortfalls - pnl_mean, horizons),
+        )
+
+    valid = ~np.isnan(returns)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, returns, 0.0).sum(axis=0) / valid.sum(axis=0)
+    covariance = pairwise_covariance(returns)
+    pnl_mean = np.array([values @ mean])
+
+    if method == "monte_carlo":
+        factor = covariance_factor(covariance)
+        centered_pnl = standard_normal_draws(simulations, values.size) @ (factor.T @ values)
+        quantiles, shortfalls = tail_statistics(centered_pnl[:, None], confidences)
+        q_table = scale_to_horizons(pnl_mean, np.ones(1), quantiles[:, 0], horizons)
+        es_table = scale_to_horizons(pnl_mean, np.ones(1), shortfalls[:, 0], horizons)
+    else:
+        pnl_std = np.array([np.sqrt(max(values @ covariance @ values, 0.0))])
+        z, tail = standard_tail_statistics(method, simulations, confidences)
+        q_table = scale_to_horizons(pnl_mean, pnl_std, z, horizons)
+        es_table = scale_to_horizons(pnl_mean, pnl_std, tail, horizons)
+    return RiskTable(confidences=tuple(confidences), horizons=tuple(horizons),
+                     quantiles=q_table, shortfalls=es_table)
@@ -5,7 +5,7 @@ Uses REST API instead of direct PostgreSQL (fixes Vercel timeout issues)
 import os
 import requests
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "").strip()
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "").strip() or os.getenv("SUPABASE_PASSWORD", "").strip()
@@ -47,6 +47,9 @@ def insert_position(*args, **kwargs):
 def delete_position(*args, **kwargs):
     raise RuntimeError("Supabase is not configured - cannot delete position")
 
+def update_position_entry(*args, **kwargs):
+    raise RuntimeError("Supabase is not configured - cannot update position entry")
+
 def get_cash():
     raise RuntimeError("Supabase is not configured - cannot fetch cash")
 
@@ -93,7 +96,8 @@ if SUPABASE_ENABLED:
     def get_all_positions() -> List[Dict[str, Any]]:
         """
         Fetch all positions from Supabase using REST API.
-        Returns: List of dicts with keys: ticker, shares, price_bought, date_bought
+        Returns: List of dicts with keys: ticker, shares, price_bought, date_bought,
+        entry_date, entry_atr, entry_key
         """
         try:
             response = requests.get(
@@ -176,6 +180,42 @@ if SUPABASE_ENABLED:
             raise Exception(f"Failed to save position: {e}")
 
 
+    def update_position_entry(ticker: str, price_bought: float, date_bought: Optional[str],
+                              entry_date: Optional[str], entry_atr: Optional[float], entry_key: str):
+        """
+        Store the inferred entry date and entry ATR on a saved position.
+        Only the row saved with the same price_bought and date_bought is updated, so an
+        entry point computed for an unsaved or since-edited row is never written.
+        """
+        ticker = (ticker or "").strip().upper()
+        if not ticker:
+            raise ValueError("Ticker cannot be empty")
+
+        try:
+            response = requests.patch(
+                f"{REST_URL}/positions",
+                headers=HEADERS,
+                params={
+                    "ticker": f"eq.{ticker}",
+                    "price_bought": f"eq.{price_bought}",
+                    "date_bought": f"eq.{date_bought}" if date_bought else "is.null",
+                },
+                json={
+                    "entry_date": entry_date,
+                    "entry_atr": entry_atr,
+                    "entry_key": entry_key
+                },
+                timeout=5
+            )
+
+            if response.status_code not in [200, 204]:
+                print(f"❌ Error updating entry for {ticker}: {response.status_code}")
+                raise Exception(f"Failed to update position entry: {response.text}")
+        except requests.exceptions.Timeout:
+            print(f"❌ Timeout updating position entry in REST API")
+            raise Exception("Timeout updating position entry")
+
+
     def delete_position(ticker: str):
         """
         Delete a position from Supabase using REST API.
@@ -1,9 +1,16 @@
+import asyncio
+import functools
+import hashlib
 import math
 import os
 import json
-from datetime import datetime, timedelta
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from pathlib import Path
-from typing import List, Optional, Dict, Set
+from typing import Annotated, Any, AsyncIterator, Callable, List, Literal, Optional, Dict, Set, Tuple
 
 # Configure yfinance cache for Vercel
 if os.environ.get("VERCEL"):
@@ -21,6 +28,7 @@ from backend.db.database_supabase import (
     get_all_positions,
     insert_position,
     delete_position,
+    update_position_entry,
     get_cash,
     update_cash,
     get_sector_allocations,
@@ -44,21 +52,98 @@ except Exception as e:
 
 import numpy as np
 import pandas as pd
-import yfinance as yf
 from fastapi import FastAPI, HTTPException, Request, Response, Depends, status, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import RedirectResponse, JSONResponse, FileResponse
+from fastapi.responses import RedirectResponse, JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from itsdangerous import URLSafeTimedSerializer
 
+from backend.analytics.atr import ATR_METHOD, atr_states
+from backend.analytics.entries import EntryPoint, entry_index, entry_key, last_bar_containing
+from backend.analytics.engine import PortfolioAnalytics, compute_portfolio_analytics
+from backend.analytics.moments import MomentsView, ReturnStats, moment_states
+from backend.analytics.options import atm_implied_vols
+from backend.analytics.var import VAR_METHODS, risk_table, var_quantiles
+from backend.market.cache import TTLCache
+from backend.market.fundamentals import fundamentals_cache
+from backend.market.history_store import history_stamp, history_store, lookback_start
+from backend.market.providers import market_data_provider
+from backend.market.singleflight import AsyncSingleFlight
+
 
 RISK_FREE_RATE = 0.0488  # fixed risk-free rate
+# Sectors always listed in the sector table, as in the frontend grid
+ALL_SECTORS = [
+    "Basic Materials",
+    "Communication Services",
+    "Consumer Cyclical",
+    "Consumer Defensive",
+    "Energy",
+    "Financial Services",
+    "Healthcare",
+    "Industrials",
+    "Real Estate",
+    "Technology",
+    "Utilities",
+]
 MARKET_PROXY = "SPY"
 ATR_WINDOW = 14
-VAR_SIMULATIONS = 5000
+VAR_SIMULATIONS = int(os.getenv("VAR_SIMULATIONS", "5000"))
 VAR_CONFIDENCE = 0.95
+# "monte_carlo" simulates VAR_SIMULATIONS normal draws, "parametric" is the closed-form delta-normal quantile,
+# "historical" takes the quantile of the observed returns over the lookback window (no normality assumption)
+VAR_METHOD = os.getenv("VAR_METHOD", "monte_carlo").strip().lower()
+if VAR_METHOD not in VAR_METHODS:
+    print(f"⚠️ Unknown VAR_METHOD '{VAR_METHOD}', using monte_carlo")
+    VAR_METHOD = "monte_carlo"
 IV_TENOR_DAYS = 30
+# Trailing betas reported next to the lookback-window beta, in trading days
+BETA_WINDOWS = {"beta_1y": 252, "beta_3y": 3 * 252}
+# Upper bounds for the VaR / Expected Shortfall table a request can ask for
+MAX_RISK_LEVELS = 10
+MAX_RISK_HORIZON_DAYS = 252
+
+# Analytics engine for /recalculate: "vectorized" computes all tickers in one matrix pass,
+# "rows" runs the scalar process_row path for each row
+RECALC_ENGINE = os.getenv("RECALC_ENGINE", "vectorized").strip().lower()
+if RECALC_ENGINE not in ("vectorized", "rows"):
+    raise RuntimeError(f"Unknown RECALC_ENGINE '{RECALC_ENGINE}' (expected 'vectorized' or 'rows')")
+# Per-row processing with RECALC_ENGINE=rows: "threads" fans rows out over a shared pool, "serial" runs them in order
+RECALC_MODE = os.getenv("RECALC_MODE", "threads").strip().lower()
+if RECALC_MODE not in ("threads", "serial"):
+    raise RuntimeError(f"Unknown RECALC_MODE '{RECALC_MODE}' (expected 'threads' or 'serial')")
+# Max rows in flight at once, shared by all concurrent /recalculate requests
+RECALC_MAX_WORKERS = int(os.getenv("RECALC_MAX_WORKERS", "16"))
+row_executor = ThreadPoolExecutor(max_workers=RECALC_MAX_WORKERS, thread_name_prefix="recalc-row")
+# Blocking network calls (yfinance, Supabase) run here instead of Starlette's shared 40-thread pool
+IO_MAX_WORKERS = int(os.getenv("IO_MAX_WORKERS", "32"))
+io_executor = ThreadPoolExecutor(max_workers=IO_MAX_WORKERS, thread_name_prefix="io")
+# Hard limit for one /recalculate request, in seconds
+RECALC_DEADLINE_SECONDS = float(os.getenv("RECALC_DEADLINE_SECONDS", "25"))
+# Memoized per-row results: a row whose inputs and last bars are unchanged is reused for at most
+# ROW_CACHE_TTL_SECONDS. With RECALC_ENGINE=rows that skips all of its analytics; the vectorized
+# engine runs one panel pass over the book (the book VaR needs it, see PANEL_CACHE_MAX_ENTRIES) and
+# the memo skips the per-row entry inference and derived fields
+ROW_CACHE_MAX_ENTRIES = int(os.getenv("ROW_CACHE_MAX_ENTRIES", "4096"))
+ROW_CACHE_TTL_SECONDS = float(os.getenv("ROW_CACHE_TTL_SECONDS", "3600"))
+# Engine passes over the whole book, reused while its tickers and their bars are unchanged, so an
+# edit that keeps the same tickers (shares, price bought) only reruns the book VaR. Each one holds the
+# book's returns panel, so keep this small
+PANEL_CACHE_MAX_ENTRIES = int(os.getenv("PANEL_CACHE_MAX_ENTRIES", "32"))
+# Whole /recalculate responses, shared by identical requests (every open tab polls the same book
+# every 60 s) until they expire or the stored bars of one of their tickers change
+RECALC_CACHE_TTL_SECONDS = float(os.getenv("RECALC_CACHE_TTL_SECONDS", "60"))
+RECALC_CACHE_MAX_ENTRIES = int(os.getenv("RECALC_CACHE_MAX_ENTRIES", "256"))
+# Responses with a row whose market data did not load are kept only this long, so the fetch is retried soon
+RECALC_ERROR_CACHE_TTL_SECONDS = float(os.getenv("RECALC_ERROR_CACHE_TTL_SECONDS", "10"))
+# Last computed state per (user, portfolio_id) for /recalculate/delta; an expired one makes the client resend the book
+DELTA_STATE_TTL_SECONDS = float(os.getenv("DELTA_STATE_TTL_SECONDS", str(24 * 3600)))
+DELTA_STATE_MAX_ENTRIES = int(os.getenv("DELTA_STATE_MAX_ENTRIES", "256"))
+# SPY sector weightings change monthly at most; refreshed in the background after one trading day
+SECTOR_WEIGHTS_TTL_SECONDS = float(os.getenv("SECTOR_WEIGHTS_TTL_SECONDS", str(24 * 3600)))
+# After a failed refresh, wait this long before asking Yahoo again
+SECTOR_WEIGHTS_RETRY_SECONDS = float(os.getenv("SECTOR_WEIGHTS_RETRY_SECONDS", "900"))
 
 # Auth Configuration
 SECRET_KEY = "super-secret-key-change-this-in-production"
@@ -78,6 +163,18 @@ def get_current_user(request: Request):
         pass
     return None
 
+async def run_io(func, *args, **kwargs):
+    """Await a blocking I/O call on the dedicated I/O pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_cpu(func, *args, **kwargs):
+    """Await CPU-bound analytics on the row pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(row_executor, functools.partial(func, *args, **kwargs))
+
+
 def require_user(user: Optional[str] = Depends(get_current_user)):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
@@ -85,6 +182,13 @@ def require_user(user: Optional[str] = Depends(get_current_user)):
 
 
 
+class RiskMeasure(BaseModel):
+    confidence: float
+    horizon_days: int
+    var: float
+    expected_shortfall: float
+
+
 class PositionIn(BaseModel):
     ticker: str = Field(..., description="Stock symbol")
     shares: float = Field(..., ge=0, description="Number of shares")
@@ -98,6 +202,8 @@ class PositionOut(PositionIn):
     position_value: float = 0.0
     atr: Optional[float] = None
     beta: Optional[float] = None
+    beta_1y: Optional[float] = None
+    beta_3y: Optional[float] = None
     weight: Optional[float] = None
     var: Optional[float] = None
     iv: Optional[float] = None
@@ -118,17 +224,85 @@ class PositionOut(PositionIn):
     weighted_expected_return: Optional[float] = None
     holding_period: Optional[int] = None
     cap_formatted: Optional[str] = None
+    var_contribution: Optional[float] = None
+    risk: Optional[List[RiskMeasure]] = None
     
     error: Optional[str] = None
 
 
-class RecalculateRequest(BaseModel):
+class RecalculateOptions(BaseModel):
+    portfolio_var: bool = Field(True, description="Also compute correlated portfolio VaR and per-position contributions")
+    var_method: Optional[Literal["monte_carlo", "parametric", "historical"]] = Field(None, description="Overrides VAR_METHOD")
+    var_confidences: Optional[List[Annotated[float, Field(gt=0.5, lt=1)]]] = Field(
+        None, max_length=MAX_RISK_LEVELS, description="Confidence levels for the VaR / Expected Shortfall table")
+    var_horizons: Optional[List[Annotated[int, Field(ge=1, le=MAX_RISK_HORIZON_DAYS)]]] = Field(
+        None, max_length=MAX_RISK_LEVELS, description="Horizons in trading days for the VaR / Expected Shortfall table")
+
+    def risk_levels(self) -> Optional[Tuple[List[float], List[int]]]:
+        """(confidences, horizons) of the requested table; either list defaults to 95% / 1 day"""
+        if not self.var_confidences and not self.var_horizons:
+            return None
+        confidences = sorted(set(self.var_confidences or [VAR_CONFIDENCE]))
+        horizons = sorted(set(self.var_horizons or [1]))
+        return confidences, horizons
+
+    def options(self) -> dict:
+        return self.model_dump(include=set(RecalculateOptions.model_fields))
+
+
+class RecalculateRequest(RecalculateOptions):
     rows: List[PositionIn]
 
 
 class RecalculateResponse(BaseModel):
     rows: List[PositionOut]
     market_sector_weights: Optional[Dict[str, float]] = None
+    portfolio_var: Optional[float] = None
+    portfolio_risk: Optional[List[RiskMeasure]] = None
+
+
+class PositionDelta(PositionIn):
+    row_id: str = Field(..., min_length=1, max_length=64, description="Client-side row id, stable across edits")
+
+
+class RecalculateDeltaRequest(RecalculateOptions):
+    portfolio_id: str = Field(..., min_length=1, max_length=128)
+    base_version: Optional[str] = Field(None, description="Version the changes apply to; omit to start over from `added`")
+    added: List[PositionDelta] = Field(default_factory=list)
+    modified: List[PositionDelta] = Field(default_factory=list)
+    removed: List[str] = Field(default_factory=list, description="Row ids")
+
+
+class RecalculateDeltaResponse(BaseModel):
+    portfolio_id: str
+    version: str
+    rows: Dict[str, Dict[str, Any]] = Field(default_factory=dict, description="Changed fields per row id, all fields for new rows")
+    removed: List[str] = Field(default_factory=list)
+    portfolio: Dict[str, Any] = Field(default_factory=dict, description="Changed portfolio-level fields")
+
+
+class PortfolioSummary(BaseModel):
+    cash: float
+    total_invested: float
+    total_portfolio_value: float
+
+
+class SectorRow(BaseModel):
+    sector: str
+    count: int
+    total_value: float
+    weight: float
+    set_allocation: float
+    allocation_goal: float
+    market_weight: float
+
+
+class PortfolioSnapshot(BaseModel):
+    positions: List[PositionOut]
+    summary: PortfolioSummary
+    sectors: List[SectorRow]
+    market_sector_weights: Optional[Dict[str, float]] = None
+    portfolio_var: Optional[float] = None
 
 
 # PositionDB no longer needs ID as ticker is PK
@@ -205,6 +379,9 @@ def check_auth(user: Optional[str] = Depends(get_current_user)):
 
 @app.on_event("startup")
 def startup():
+    # Warm the sector weights cache so the first recalc does not come back without them
+    io_executor.submit(refresh_market_sector_weights)
+    io_executor.submit(load_entry_points)
     try:
         init_db()
     except RuntimeError as e:
@@ -241,9 +418,11 @@ def health_check():
 
 
 @app.get("/positions", response_model=List[PositionDB], dependencies=[Depends(require_user)])
-def read_positions():
+async def read_positions():
     try:
-        return get_all_positions()
+        positions = await run_io(get_all_positions)
+        entry_index.seed(positions, ATR_WINDOW, ATR_METHOD)
+        return positions
     except RuntimeError as e:
         # Supabase not configured
         raise HTTPException(status_code=503, detail=f"Database unavailable: {str(e)}")
@@ -266,10 +445,11 @@ async def create_position(pos: PositionIn):
         
         # Insert into Supabase (single source of truth)
         try:
-            insert_position(ticker, shares, price_bought, date_bought)
+            await run_io(insert_position, ticker, shares, price_bought, date_bought)
         except RuntimeError as db_err:
             # Supabase not configured
             raise HTTPException(status_code=503, detail=str(db_err))
+        entry_index.mark_saved(ticker, entry_key(price_bought, date_bought, ATR_WINDOW, ATR_METHOD))
         
         # Return the object that was just saved
         return PositionDB(
@@ -294,9 +474,10 @@ async def delete_position_endpoint(ticker: str):
         
         # Delete from Supabase (single source of truth)
         try:
-            delete_position(ticker)
+            await run_io(delete_position, ticker)
         except RuntimeError as db_err:
             raise HTTPException(status_code=503, detail=str(db_err))
+        entry_index.forget_saved(ticker)
         
         return {"ok": True, "message": f"Position {ticker} deleted"}
     except HTTPException:
@@ -364,9 +545,9 @@ async def websocket_endpoint(websocket: WebSocket):
 
 
 @app.get("/cash", response_model=CashUpdate, dependencies=[Depends(require_user)])
-def read_cash():
+async def read_cash():
     try:
-        return {"amount": get_cash()}
+        return {"amount": await run_io(get_cash)}
     except RuntimeError as e:
         raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
@@ -379,7 +560,7 @@ async def update_cash_endpoint(cash: CashUpdate):
     try:
         # Update in Supabase (single source of truth)
         try:
-            update_cash(cash.amount)
+            await run_io(update_cash, cash.amount)
         except RuntimeError as db_err:
             raise HTTPException(status_code=503, detail=str(db_err))
         
@@ -398,10 +579,10 @@ async def update_cash_endpoint(cash: CashUpdate):
 
 
 @app.get("/sector-allocations", response_model=Dict[str, float], dependencies=[Depends(require_user)])
-def read_sector_allocations():
+async def read_sector_allocations():
     try:
         # Fetch from Supabase (single source of truth)
-        return get_sector_allocations()
+        return await run_io(get_sector_allocations)
     except RuntimeError as e:
         raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
@@ -415,7 +596,7 @@ async def update_sector_allocation_endpoint(alloc: SectorAllocationUpdate):
         # SAFE: Always use upsert, never delete to preserve data
         # Set to 0 to disable allocation, but keep record in database
         try:
-            upsert_sector_allocation(alloc.sector, alloc.allocation)
+            await run_io(upsert_sector_allocation, alloc.sector, alloc.allocation)
         except RuntimeError as db_err:
             raise HTTPException(status_code=503, detail=str(db_err))
         
@@ -442,105 +623,82 @@ app.add_middleware(
 )
 
 
-def norm_cdf(x: float) -> float:
-    return 0.5 * (1.0 + math.erf(x / math.sqrt(2)))
-
+def estimate_implied_vol(spot: float, r: float, tenor_days: int, stats: ReturnStats) -> Optional[float]:
+    """ATM implied volatility targeting a call priced off the realized volatility (see atm_implied_vols)"""
+    if spot <= 0 or stats.count < 5:
+        return None
+    iv = atm_implied_vols(spot, r, tenor_days, stats.std * math.sqrt(252))
+    return None if np.isnan(iv) else round(float(iv), 4)
 
-def black_scholes_call_price(s: float, k: float, r: float, sigma: float, t: float) -> float:
-    if s <= 0 or k <= 0 or sigma <= 0 or t <= 0:
-        return 0.0
-    d1 = (math.log(s / k) + (r + 0.5 * sigma**2) * t) / (sigma * math.sqrt(t))
-    d2 = d1 - sigma * math.sqrt(t)
-    return s * norm_cdf(d1) - k * math.exp(-r * t) * norm_cdf(d2)
 
+def return_stats(returns: np.ndarray) -> ReturnStats:
+    return ReturnStats(count=int(returns.size), mean=float(np.mean(returns)), std=float(np.std(returns)))
 
-def estimate_implied_vol(spot: float, r: float, tenor_days: int, returns: np.ndarray) -> Optional[float]:
-    if spot <= 0 or returns.size < 5:
-        return None
-    # Use realized volatility as the starting point and target an ATM call priced off that estimate.
-    sigma_guess = float(np.std(returns) * math.sqrt(252))
-    if sigma_guess <= 0:
-        return None
-    t = tenor_days / 365.0
-    target_price = black_scholes_call_price(spot, spot, r, sigma_guess, t)
-    if target_price <= 0:
-        return None
 
-    sigma = sigma_guess
-    for _ in range(8):
-        price = black_scholes_call_price(spot, spot, r, sigma, t)
-        if price <= 0:
-            break
-        # Vega for ATM call
-        d1 = (math.log(1) + (r + 0.5 * sigma**2) * t) / (sigma * math.sqrt(t))
-        vega = spot * math.sqrt(t) * (1 / math.sqrt(2 * math.pi)) * math.exp(-0.5 * d1**2)
-        if vega <= 1e-8:
-            break
-        sigma -= (price - target_price) / vega
-        if sigma <= 0:
-            sigma = sigma_guess
-            break
-    return max(round(sigma, 4), 0.0)
-
-
-def compute_beta(stock_returns: np.ndarray, market_returns: np.ndarray) -> Optional[float]:
-    if stock_returns.size == 0 or market_returns.size == 0:
-        return None
-    # Align lengths
-    min_len = min(len(stock_returns), len(market_returns))
-    s_ret = stock_returns[-min_len:]
-    m_ret = market_returns[-min_len:]
-    
-    covariance = np.cov(s_ret, m_ret)[0, 1]
-    variance = np.var(m_ret)
-    if variance == 0:
+def var_return_quantile(returns: np.ndarray, method: Optional[str] = None,
+                        stats: Optional[ReturnStats] = None) -> Optional[float]:
+    """Return at the VaR cutoff of the 1-day return distribution (stats: moments of returns, if known)"""
+    if returns.size < 2:
         return None
-    return round(float(covariance / variance), 4)
+    stats = stats or return_stats(returns)
+    return float(var_quantiles(np.array([stats.mean]), np.array([stats.std]), method or VAR_METHOD,
+                               VAR_SIMULATIONS, VAR_CONFIDENCE, returns[:, None])[0])
 
 
-def compute_var(position_value: float, returns: np.ndarray) -> Optional[float]:
-    if returns.size < 2:
+def compute_var(position_value: float, returns: np.ndarray, method: Optional[str] = None,
+                stats: Optional[ReturnStats] = None) -> Optional[float]:
+    var_percent = var_return_quantile(returns, method, stats)
+    if var_percent is None:
         return None
-    # Monte Carlo VaR
-    mu = np.mean(returns)
-    sigma = np.std(returns)
-    simulated_returns = np.random.normal(mu, sigma, VAR_SIMULATIONS)
-    simulated_returns.sort()
-    cutoff_index = int((1 - VAR_CONFIDENCE) * VAR_SIMULATIONS)
-    var_percent = simulated_returns[cutoff_index]
     return round(abs(position_value * var_percent), 2)
 
 
-def compute_atr_series(history):
-    if history is None or history.empty:
+def risk_return_table(returns: np.ndarray, method: Optional[str], levels: Tuple[List[float], List[int]],
+                      stats: Optional[ReturnStats] = None):
+    """(confidence, horizon, quantile, shortfall) levels of one return series"""
+    if returns.size < 2:
         return None
-    highs = history["High"]
-    lows = history["Low"]
-    closes = history["Close"]
-    prev_closes = closes.shift(1)
-    
-    tr1 = highs - lows
-    tr2 = (highs - prev_closes).abs()
-    tr3 = (lows - prev_closes).abs()
-    
-    tr = np.maximum.reduce([tr1, tr2, tr3])
-    # Convert to Series to use rolling
-    tr_series = pd.Series(tr, index=history.index)
-    atr_series = tr_series.rolling(window=ATR_WINDOW).mean()
-    return atr_series
-
-
-def fetch_ticker_data(ticker: str):
-    ticker_obj = yf.Ticker(ticker)
-    # Fetch max history to ensure we cover old purchase dates
-    history = ticker_obj.history(period="max", auto_adjust=True)
-    # Ensure timezone naive index for easier comparison
-    if not history.empty:
-        history.index = history.index.tz_localize(None)
-    info = ticker_obj.info
+    stats = stats or return_stats(returns)
+    table = risk_table(np.array([stats.mean]), np.array([stats.std]), method or VAR_METHOD,
+                       VAR_SIMULATIONS, *levels, returns=returns[:, None])
+    return list(table.levels(0))
+
+
+def risk_measures(value: float, levels) -> List[RiskMeasure]:
+    """Risk table levels of return quantiles scaled to currency amounts for a value"""
+    return [
+        RiskMeasure(confidence=confidence, horizon_days=horizon,
+                    var=round(abs(value * quantile), 2), expected_shortfall=round(abs(value * shortfall), 2))
+        for confidence, horizon, quantile, shortfall in levels
+    ]
+
+
+def fetch_ticker_data(ticker: str, history: Optional[pd.DataFrame] = None, info: Optional[dict] = None):
+    # Daily history comes from the on-disk store, which only downloads bars newer than
+    # the last stored date (timezone naive index for easier comparison).
+    # Callers that already ran the batch market-data stage pass the history in.
+    if history is None:
+        history = history_store.get(ticker)
+    # sector / marketCap come from the long-lived fundamentals cache, not Ticker.info
+    if info is None:
+        info = fundamentals_cache.get(ticker)
     return history, info
 
 
+def fetch_market_data(tickers: List[str]) -> Dict[str, pd.DataFrame]:
+    """
+    Batch market-data stage: histories for every distinct ticker of a request
+    (plus the market proxy) in one bulk download.
+    """
+    wanted = {t.strip().upper() for t in tickers if t and t.strip()}
+    wanted.add(MARKET_PROXY)
+    return history_store.get_many(wanted)
+
+
+def round_or_none(value: Optional[float], digits: int = 4) -> Optional[float]:
+    return None if value is None else round(value, digits)
+
+
 def format_market_cap(val: float) -> str:
     if not val:
         return ""
@@ -553,53 +711,115 @@ def format_market_cap(val: float) -> str:
     return f"{val:.2f}"
 
 
-def process_row(ticker: str, shares: float, price_bought: float, date_bought: Optional[str], market_returns: np.ndarray):
-    ticker = ticker.upper()
-    history, info = fetch_ticker_data(ticker)
-    if history is None or history.empty:
-        raise HTTPException(status_code=400, detail=f"No market data for {ticker}")
-    closes = history["Close"]
-    current_price = float(round(closes.iloc[-1], 4))
-    returns = np.log(closes / closes.shift(1)).dropna().to_numpy()
-    position_value = float(round(current_price * shares, 2))
-    value_paid = float(round(price_bought * shares, 2))
+def needs_deep_history(ticker: str, history: pd.DataFrame, price_bought: float, date_bought: Optional[str]) -> bool:
+    """True when entry lookups need bars older than the stored window"""
+    if history_store.is_complete(ticker) or history.empty:
+        return False
+    if entry_index.get(ticker, entry_key(price_bought, date_bought, ATR_WINDOW, ATR_METHOD)) is not None:
+        return False
+    if price_bought > 0:
+        return last_bar_containing(history["Low"].to_numpy(), history["High"].to_numpy(), price_bought) < 0
+    if date_bought:
+        try:
+            return datetime.strptime(date_bought, "%Y-%m-%d") < history.index[0]
+        except ValueError:
+            return False
+    return False
+
+
+def load_entry_points():
+    """Seed the entry index from entry points persisted with the saved positions"""
+    try:
+        loaded = entry_index.seed(get_all_positions(), ATR_WINDOW, ATR_METHOD)
+        print(f"✅ Loaded {loaded} stored entry points")
+    except RuntimeError:
+        pass  # Supabase not configured
+    except Exception as e:
+        print(f"⚠️ Could not load stored entry points: {e}")
+
+
+def persist_entry_point(ticker: str, price_bought: float, date_bought: Optional[str], point: EntryPoint, key: str):
+    try:
+        update_position_entry(ticker, price_bought, date_bought, point.date, point.atr, key)
+    except RuntimeError:
+        pass  # Supabase not configured
+    except Exception as e:
+        entry_index.release_write(ticker, key)
+        print(f"⚠️ Could not store entry point for {ticker}: {e}")
+
+
+PRICE_NOT_IN_HISTORY = "Price {} not found in history"
 
-    atr_series = compute_atr_series(history)
-    current_atr = float(round(atr_series.iloc[-1], 4)) if atr_series is not None and not np.isnan(atr_series.iloc[-1]) else None
-    
-    entry_atr = None
-    inferred_date = date_bought
 
-    # Try to infer date from price if price_bought is provided
+def infer_entry_point(price_bought: float, date_bought: Optional[str], history: pd.DataFrame,
+                      atr_at: Callable[[datetime], Optional[float]]) -> EntryPoint:
+    """Reverse scan for the entry bar (when price_bought is given) and the ATR on it"""
+    # A blank date from the grid is no date, the same as a null one from the database
+    inferred_date = date_bought or None
     if price_bought > 0:
-        # Find rows where Low <= price_bought <= High
-        mask = (history["Low"] <= price_bought) & (history["High"] >= price_bought)
-        matches = history[mask]
-        if not matches.empty:
-            # Use the most recent match
-            match_date = matches.index[-1]
-            inferred_date = match_date.strftime("%Y-%m-%d")
-        else:
-            # Price not found in history
-            raise ValueError(f"Price {price_bought} not found in history")
-    
-    holding_period = 0
-    if inferred_date and atr_series is not None:
+        idx = last_bar_containing(history["Low"].to_numpy(), history["High"].to_numpy(), price_bought)
+        if idx < 0:
+            raise ValueError(PRICE_NOT_IN_HISTORY.format(price_bought))
+        inferred_date = history.index[idx].strftime("%Y-%m-%d")
+
+    entry_atr = None
+    if inferred_date:
         try:
-            dt = datetime.strptime(inferred_date, "%Y-%m-%d")
-            holding_period = (datetime.now() - dt).days
-            # Find the closest date in history (on or before)
-            idx = history.index.get_indexer([dt], method='pad')[0]
-            if idx != -1:
-                val = atr_series.iloc[idx]
-                if not np.isnan(val):
-                    entry_atr = float(round(val, 4))
+            # ATR on the closest date in history (on or before)
+            entry_atr = atr_at(datetime.strptime(inferred_date, "%Y-%m-%d"))
         except Exception:
             pass
 
-    beta = compute_beta(returns, market_returns) if market_returns.size else None
-    var = compute_var(position_value, returns)
-    iv = estimate_implied_vol(current_price, RISK_FREE_RATE, IV_TENOR_DAYS, returns)
+    return EntryPoint(date=inferred_date, atr=entry_atr)
+
+
+def resolve_entry_point(ticker: str, price_bought: float, date_bought: Optional[str], history: pd.DataFrame,
+                        atr_at: Callable[[datetime], Optional[float]]) -> EntryPoint:
+    """
+    Entry date and entry ATR of a row. With price_bought, the entry date is the most recent
+    bar whose range contains it. Computed once per (ticker, price_bought, date_bought) and
+    ATR settings; when a saved position has those inputs, it is also stored with it in the
+    background (unsaved grid rows and lookups are only kept in memory).
+    """
+    key = entry_key(price_bought, date_bought, ATR_WINDOW, ATR_METHOD)
+    point = entry_index.get(ticker, key)
+    if point is None:
+        point = infer_entry_point(price_bought, date_bought, history, atr_at)
+        entry_index.set(ticker, key, point)
+    write_back_entry_point(ticker, price_bought, date_bought, point, key)
+    return point
+
+
+def write_back_entry_point(ticker: str, price_bought: float, date_bought: Optional[str], point: EntryPoint, key: str):
+    if entry_index.claim_write(ticker, key):
+        io_executor.submit(persist_entry_point, ticker, price_bought, date_bought, point, key)
+
+
+def assemble_position(ticker: str, shares: float, price_bought: float, date_bought: Optional[str],
+                      history: pd.DataFrame, info: dict, metrics: Dict[str, Optional[float]],
+                      atr_at: Callable[[datetime], Optional[float]],
+                      market_annual_return: Optional[float]) -> PositionOut:
+    """
+    Entry-date inference and derived fields for one row, given its per-ticker metrics
+    (current_price, atr, beta, var_quantile, iv) and an ATR lookup by date.
+    """
+    current_price = metrics["current_price"]
+    current_atr = metrics["atr"]
+    beta = metrics["beta"]
+    iv = metrics["iv"]
+    position_value = float(round(current_price * shares, 2))
+    value_paid = float(round(price_bought * shares, 2))
+    var = round(abs(position_value * metrics["var_quantile"]), 2) if metrics["var_quantile"] is not None else None
+    risk = risk_measures(position_value, metrics["risk"]) if metrics.get("risk") else None
+
+    inferred_date, entry_atr = resolve_entry_point(ticker, price_bought, date_bought, history, atr_at)
+
+    holding_period = 0
+    if inferred_date:
+        try:
+            holding_period = (datetime.now() - datetime.strptime(inferred_date, "%Y-%m-%d")).days
+        except ValueError:
+            pass
 
     atr_change = round(current_atr - entry_atr, 4) if current_atr is not None and entry_atr is not None else None
     pct_change = round((current_price - price_bought) / price_bought, 4) if price_bought > 0 else 0.0
@@ -626,11 +846,10 @@ def process_row(ticker: str, shares: float, price_bought: float, date_bought: Op
 
     # CAPM Expected Return
     # Rf + Beta * (Rm - Rf)
-    # Estimate Rm from market_returns (annualized)
+    # Rm is the annualized mean market return
     expected_return = None
-    if beta is not None and market_returns.size > 0:
-        annual_market_return = np.mean(market_returns) * 252
-        expected_return = round(RISK_FREE_RATE + beta * (annual_market_return - RISK_FREE_RATE), 6)
+    if beta is not None and market_annual_return is not None:
+        expected_return = round(RISK_FREE_RATE + beta * (market_annual_return - RISK_FREE_RATE), 6)
 
     return PositionOut(
         ticker=ticker,
@@ -642,8 +861,10 @@ def process_row(ticker: str, shares: float, price_bought: float, date_bought: Op
         position_value=position_value,
         atr=current_atr,
         beta=beta,
+        **{name: metrics.get(name) for name in BETA_WINDOWS},
         weight=None,  # filled later after total value is known
         var=var,
+        risk=risk,
         iv=iv,
         atr_change=atr_change,
         pct_change=pct_change,
@@ -661,58 +882,332 @@ def process_row(ticker: str, shares: float, price_bought: float, date_bought: Op
     )
 
 
-def get_market_returns() -> np.ndarray:
-    history, _ = fetch_ticker_data(MARKET_PROXY)
+def process_row(ticker: str, shares: float, price_bought: float, date_bought: Optional[str], market: Optional[MomentsView],
+                history: Optional[pd.DataFrame] = None, info: Optional[dict] = None, var_method: Optional[str] = None,
+                risk_levels: Optional[Tuple[List[float], List[int]]] = None):
+    """
+    Single-row path: per-ticker metrics computed with the scalar helpers above, from the
+    ticker's return moments (paired with the market's, which must be up to date)
+    """
+    ticker = ticker.upper()
+    history, info = fetch_ticker_data(ticker, history, info)
+    if history is None or history.empty:
+        raise HTTPException(status_code=400, detail=f"No market data for {ticker}")
+
+    # Entry lookups may need bars older than the default window: fetch the full history once
+    if needs_deep_history(ticker, history, price_bought, date_bought):
+        history = history_store.extend(ticker)
+
+    current_price = float(round(history["Close"].iloc[-1], 4))
+
+    # Only bars added since the last request are run through the ATR and moment states
+    atr_series = atr_states.get(ticker, history, ATR_WINDOW, ATR_METHOD)
+    moments = moment_states.get(ticker, history, MARKET_PROXY if market is not None else None)
+    first = moments.first_position(lookback_start())
+    stats = moments.stats(first)
+    returns = moments.window_returns(first)
+
+    metrics = {
+        "current_price": current_price,
+        "atr": atr_series.latest,
+        "beta": round_or_none(moments.beta(first)),
+        **{name: round_or_none(moments.beta(moments.trailing_position(days))) for name, days in BETA_WINDOWS.items()},
+        "var_quantile": var_return_quantile(returns, var_method, stats),
+        "iv": estimate_implied_vol(current_price, RISK_FREE_RATE, IV_TENOR_DAYS, stats),
+        "risk": risk_return_table(returns, var_method, risk_levels, stats) if risk_levels else None,
+    }
+    market_annual_return = None
+    if market is not None:
+        market_stats = market.stats(market.first_position(lookback_start()))
+        if market_stats.count > 0:
+            market_annual_return = float(market_stats.mean * 252)
+    return assemble_position(ticker, shares, price_bought, date_bought, history, info, metrics, atr_series.at,
+                             market_annual_return)
+
+
+panel_cache = TTLCache(ttl_seconds=ROW_CACHE_TTL_SECONDS, max_entries=PANEL_CACHE_MAX_ENTRIES)
+
+
+def portfolio_analytics(histories: Dict[str, pd.DataFrame], var_method: str,
+                        risk_levels: Optional[Tuple[List[float], List[int]]] = None) -> PortfolioAnalytics:
+    """The engine pass over these histories, memoized on their stamps and the risk settings"""
+    key = (
+        tuple(sorted((ticker, history_stamp(history)) for ticker, history in histories.items())),
+        var_method, tuple(map(tuple, risk_levels)) if risk_levels else None, lookback_start(),
+    )
+    analytics = panel_cache.get(key)
+    if analytics is None:
+        analytics = compute_analytics(histories, var_method, risk_levels)
+        panel_cache.set(key, analytics)
+    return analytics
+
+
+def compute_analytics(histories: Dict[str, pd.DataFrame], var_method: str,
+                      risk_levels: Optional[Tuple[List[float], List[int]]] = None) -> PortfolioAnalytics:
+    return compute_portfolio_analytics(
+        histories,
+        market_proxy=MARKET_PROXY,
+        window_start=lookback_start(),
+        atr_window=ATR_WINDOW,
+        atr_method=ATR_METHOD,
+        var_method=var_method,
+        var_simulations=VAR_SIMULATIONS,
+        var_confidence=VAR_CONFIDENCE,
+        var_confidences=risk_levels[0] if risk_levels else None,
+        var_horizons=risk_levels[1] if risk_levels else None,
+        beta_windows=BETA_WINDOWS,
+        risk_free_rate=RISK_FREE_RATE,
+        iv_tenor_days=IV_TENOR_DAYS,
+    )
+
+
+def process_rows_vectorized(rows: List[PositionIn], histories: Dict[str, pd.DataFrame], infos: Dict[str, dict],
+                            var_method: str, risk_levels: Optional[Tuple[List[float], List[int]]] = None
+                            ) -> Tuple[List[PositionOut], PortfolioAnalytics]:
+    """
+    Portfolio path: one engine pass computes every ticker's metrics, then each row
+    only does its entry-date inference and derived fields, memoized like the per-row path.
+    The engine pass is reused while the book's tickers and bars are unchanged.
+    """
+    analytics = portfolio_analytics(histories, var_method, risk_levels)
+
+    def assemble(row: PositionIn, ticker: str) -> PositionOut:
+        try:
+            if ticker not in analytics:
+                raise HTTPException(status_code=400, detail=f"No market data for {ticker}")
+            return assemble_position(
+                ticker, row.shares, row.price_bought, row.date_bought,
+                histories[ticker], infos.get(ticker) or {}, analytics.metrics(ticker),
+                functools.partial(analytics.atr_at, ticker), analytics.market_annual_return,
+            )
+        except Exception as e:
+            return error_position(row, e)
+
+    def run_row(row: PositionIn) -> PositionOut:
+        ticker = row.ticker.strip().upper()
+        key = row_result_key(row, histories.get(ticker), infos.get(ticker), histories.get(MARKET_PROXY),
+                             var_method, risk_levels)
+        return memoized_row(key, row, lambda: assemble(row, ticker))
+
+    return [run_row(row) for row in rows], analytics
+
+
+def book_values(processed: List[PositionOut]) -> Dict[str, float]:
+    """Total position value per ticker over the rows that priced successfully"""
+    ticker_values: Dict[str, float] = {}
+    for row in processed:
+        if row.error is None and row.position_value:
+            ticker_values[row.ticker] = ticker_values.get(row.ticker, 0.0) + row.position_value
+    return ticker_values
+
+
+def apply_portfolio_var(processed: List[PositionOut], analytics: PortfolioAnalytics, var_method: str) -> Optional[float]:
+    """Correlated book VaR; each row gets its share of its ticker's contribution"""
+    ticker_values = book_values(processed)
+    result = analytics.portfolio_var(ticker_values, var_method, VAR_SIMULATIONS, VAR_CONFIDENCE)
+    if result is None:
+        return None
+    var, contributions = result
+    for row in processed:
+        if row.ticker in contributions and row.position_value:
+            share = row.position_value / ticker_values[row.ticker]
+            row.var_contribution = round(contributions[row.ticker] * share, 2)
+    return round(var, 2)
+
+
+def compute_portfolio_risk(processed: List[PositionOut], analytics: PortfolioAnalytics, var_method: str,
+                           risk_levels: Tuple[List[float], List[int]]) -> Optional[List[RiskMeasure]]:
+    """Correlated book VaR / Expected Shortfall at every requested confidence and horizon"""
+    table = analytics.portfolio_risk(book_values(processed), var_method, VAR_SIMULATIONS, *risk_levels)
+    if table is None:
+        return None
+    # The table already holds P&L amounts, so scale by 1
+    return risk_measures(1.0, table.levels(0))
+
+
+def get_market_moments(history: Optional[pd.DataFrame] = None) -> Optional[MomentsView]:
+    """
+    Return moments of the market proxy, brought up to date with its latest bars.
+    Every row's beta is paired against this state, so it must be refreshed first.
+    """
+    if history is None:
+        history = history_store.get(MARKET_PROXY)
     if history is None or history.empty:
-        return np.array([])
-    closes = history["Close"]
-    return np.log(closes / closes.shift(1)).dropna().to_numpy()
+        return None
+    return moment_states.get(MARKET_PROXY, history, MARKET_PROXY)
+
+
+def fetch_market_sector_weights() -> Dict[str, float]:
+    return market_data_provider.sector_weights(MARKET_PROXY)
+
 
+sector_weights_cache = TTLCache(ttl_seconds=SECTOR_WEIGHTS_TTL_SECONDS)
+sector_weights_refresh_lock = threading.Lock()
 
-def get_market_sector_weights() -> Dict[str, float]:
+
+def refresh_market_sector_weights():
+    """
+    Fetch SPY sector weights into the cache. On failure the previous value (or None) stays
+    in place and counts as fresh for SECTOR_WEIGHTS_RETRY_SECONDS, so requests arriving
+    meanwhile do not each schedule another Yahoo call.
+    """
+    if not sector_weights_refresh_lock.acquire(blocking=False):
+        return  # a refresh is already running
     try:
-        spy = yf.Ticker(MARKET_PROXY)
-        # Try funds_data (newer yfinance)
-        if hasattr(spy, 'funds_data') and spy.funds_data and spy.funds_data.sector_weightings:
-            return spy.funds_data.sector_weightings
-        
-        # Fallback to info
-        info = spy.info
-        if 'sectorWeightings' in info:
-            # Usually a list of dicts: [{'sector': '...', 'weight': ...}]
-            sw = info['sectorWeightings']
-            if isinstance(sw, list):
-                return {item['sector']: item['weight'] for item in sw}
-            elif isinstance(sw, dict):
-                return sw
-        
-        return {}
-    except Exception:
-        return {}
+        weights = fetch_market_sector_weights()
+        if weights:
+            sector_weights_cache.set(MARKET_PROXY, weights)
+            return
+        print(f"⚠️ No sector weights returned for {MARKET_PROXY}, keeping cached value")
+    except Exception as e:
+        print(f"⚠️ Failed to refresh {MARKET_PROXY} sector weights, keeping cached value: {e}")
+    finally:
+        sector_weights_refresh_lock.release()
+    if sector_weights_cache.get_entry(MARKET_PROXY) is not None:
+        sector_weights_cache.touch(MARKET_PROXY, ttl_seconds=SECTOR_WEIGHTS_RETRY_SECONDS)
+    else:
+        sector_weights_cache.set(MARKET_PROXY, None, ttl_seconds=SECTOR_WEIGHTS_RETRY_SECONDS)
 
 
-@app.post("/recalculate", response_model=RecalculateResponse, dependencies=[Depends(require_user)])
-def recalculate(payload: RecalculateRequest):
-    if not payload.rows:
-        return RecalculateResponse(rows=[])
+def get_market_sector_weights() -> Optional[Dict[str, float]]:
+    """
+    Cached SPY sector weights. Never blocks: an expired or missing entry schedules a
+    background refresh and the stale value (or None before the first load) is returned.
+    """
+    entry = sector_weights_cache.get_entry(MARKET_PROXY)
+    if entry is None or not entry.fresh:
+        io_executor.submit(refresh_market_sector_weights)
+    return entry.value if entry is not None else None
 
-    market_returns = get_market_returns()
-    market_sector_weights = get_market_sector_weights()
 
-    processed = []
-    for row in payload.rows:
+def error_position(row: PositionIn, e: Exception) -> PositionOut:
+    # Return row with error
+    return PositionOut(
+        ticker=row.ticker,
+        shares=row.shares,
+        price_bought=row.price_bought,
+        date_bought=row.date_bought,
+        error=str(e)
+    )
+
+
+def process_row_safe(row: PositionIn, market: Optional[MomentsView], history: Optional[pd.DataFrame] = None,
+                     info: Optional[dict] = None, var_method: Optional[str] = None,
+                     risk_levels: Optional[Tuple[List[float], List[int]]] = None) -> PositionOut:
+    """process_row that never raises: a failing row is returned with its error message"""
+    try:
+        return process_row(row.ticker, row.shares, row.price_bought, row.date_bought, market, history, info,
+                           var_method, risk_levels)
+    except Exception as e:
+        return error_position(row, e)
+
+
+row_results_cache = TTLCache(ttl_seconds=ROW_CACHE_TTL_SECONDS, max_entries=ROW_CACHE_MAX_ENTRIES)
+
+
+def last_bar(history: Optional[pd.DataFrame]) -> Optional[Tuple[pd.Timestamp, float]]:
+    """Date and close of the last bar (an intraday bar is revised in place, so the close counts too)"""
+    if history is None or history.empty:
+        return None
+    return history.index[-1], float(history["Close"].iloc[-1])
+
+
+def row_result_key(row: PositionIn, history: Optional[pd.DataFrame], info: Optional[dict],
+                   market_history: Optional[pd.DataFrame], var_method: Optional[str],
+                   risk_levels: Optional[Tuple[List[float], List[int]]]) -> Optional[tuple]:
+    """
+    Everything a row's result depends on: its inputs, the last bar of the ticker and of
+    the market, the fundamentals it shows, the risk settings and today's date for
+    holding_period. None when the history or fundamentals have not been loaded yet.
+    """
+    if history is None or history.empty or info is None:
+        return None
+    return (
+        row.ticker, row.shares, row.price_bought, row.date_bought or None,
+        last_bar(history), last_bar(market_history),
+        info.get("sector"), info.get("marketCap"),
+        var_method or VAR_METHOD, tuple(map(tuple, risk_levels)) if risk_levels else None,
+        date.today(),
+    )
+
+
+def memoized_row(key: Optional[tuple], row: PositionIn, compute: Callable[[], PositionOut]) -> PositionOut:
+    """
+    A row result memoized on its row_result_key. Rows that failed are not stored, and every
+    caller gets its own copy since weights are filled in afterwards. A hit echoes the
+    caller's own inputs (the key treats a blank and a null date_bought alike) and still
+    writes the entry point back if the row has since been saved.
+    """
+    if key is not None:
+        cached = row_results_cache.get(key)
+        if cached is not None:
+            echoed = {"ticker": row.ticker, "shares": row.shares, "price_bought": row.price_bought}
+            if not row.price_bought > 0:
+                # Without price_bought the entry date is the one given, not an inferred one
+                echoed["date_bought"] = row.date_bought or None
+            ticker = row.ticker.strip().upper()
+            entry = entry_key(row.price_bought, row.date_bought, ATR_WINDOW, ATR_METHOD)
+            point = entry_index.get(ticker, entry)
+            if point is not None:
+                write_back_entry_point(ticker, row.price_bought, row.date_bought, point, entry)
+            return cached.model_copy(update=echoed, deep=True)
+    result = compute()
+    if key is not None and result.error is None:
+        row_results_cache.set(key, result.model_copy(deep=True))
+    return result
+
+
+def process_row_cached(row: PositionIn, market: Optional[MomentsView], market_history: Optional[pd.DataFrame],
+                       history: Optional[pd.DataFrame] = None, info: Optional[dict] = None,
+                       var_method: Optional[str] = None,
+                       risk_levels: Optional[Tuple[List[float], List[int]]] = None) -> PositionOut:
+    """process_row_safe memoized on row_result_key"""
+    key = row_result_key(row, history, info, market_history, var_method, risk_levels)
+    return memoized_row(key, row, lambda: process_row_safe(row, market, history, info, var_method, risk_levels))
+
+
+async def load_recalc_inputs(tickers: List[str]) -> Tuple[Dict[str, pd.DataFrame], Dict[str, dict]]:
+    """Price histories (one batch download) and fundamentals of the tickers, fetched concurrently on the I/O pool"""
+    async def load_histories() -> Dict[str, pd.DataFrame]:
+        try:
+            return await run_io(fetch_market_data, tickers)
+        except Exception as e:
+            # Fall back to per-ticker fetches
+            print(f"⚠️ Batch market data download failed: {e}")
+            return {}
+
+    histories, *fundamentals = await asyncio.gather(
+        load_histories(),
+        *(run_io(fundamentals_cache.get, ticker) for ticker in tickers),
+    )
+    return histories, dict(zip(tickers, fundamentals))
+
+
+async def load_market_history(histories: Dict[str, pd.DataFrame]) -> Optional[pd.DataFrame]:
+    """The market proxy's history from the batch, or from the store when the batch missed it"""
+    history = histories.get(MARKET_PROXY)
+    if history is None:
+        history = await run_io(history_store.get, MARKET_PROXY)
+    return history
+
+
+async def fill_histories(tickers: List[str], histories: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+    """histories plus the stored history of every ticker (and the market proxy) the batch missed"""
+    async def load_history(ticker: str) -> pd.DataFrame:
         try:
-            processed.append(process_row(row.ticker, row.shares, row.price_bought, row.date_bought, market_returns))
+            return await run_io(history_store.get, ticker)
         except Exception as e:
-            # Return row with error
-            processed.append(PositionOut(
-                ticker=row.ticker,
-                shares=row.shares,
-                price_bought=row.price_bought,
-                date_bought=row.date_bought,
-                error=str(e)
-            ))
+            print(f"⚠️ Failed to fetch history for {ticker}: {e}")
+            return pd.DataFrame()
+
+    missing = [t for t in tickers + [MARKET_PROXY] if t not in histories]
+    if missing:
+        histories = {**histories, **dict(zip(missing, await asyncio.gather(*(load_history(t) for t in missing))))}
+    return histories
 
+
+def apply_weights(processed: List[PositionOut]):
+    """Portfolio weights and the weighted beta / expected return of every row"""
     total_value = sum(row.position_value for row in processed if row.position_value)
     for row in processed:
         row.weight = round(row.position_value / total_value, 4) if total_value else None
@@ -721,7 +1216,429 @@ def recalculate(payload: RecalculateRequest):
         if row.expected_return is not None and row.weight is not None:
             row.weighted_expected_return = round(row.expected_return * row.weight, 6)
 
-    return RecalculateResponse(rows=processed, market_sector_weights=market_sector_weights)
+
+async def recalculate_rows(payload: RecalculateRequest) -> RecalculateResponse:
+    """
+    Async recalc pipeline: price histories and fundamentals are fetched concurrently on the
+    I/O pool (sector weights come from their background-refreshed cache), then the
+    analytics run on the row pool.
+    """
+    rows = payload.rows
+    var_method = payload.var_method or VAR_METHOD
+    risk_levels = payload.risk_levels()
+    analytics = None
+    tickers = sorted({row.ticker.strip().upper() for row in rows if row.ticker and row.ticker.strip()})
+
+    market_sector_weights = get_market_sector_weights()
+    histories, infos = await load_recalc_inputs(tickers)
+
+    if RECALC_ENGINE == "rows":
+        market_history = await load_market_history(histories)
+        market = await run_cpu(get_market_moments, market_history)
+
+        def run_row(row: PositionIn) -> PositionOut:
+            ticker = row.ticker.strip().upper()
+            return process_row_cached(row, market, market_history, histories.get(ticker), infos.get(ticker),
+                                      var_method, risk_levels)
+
+        if RECALC_MODE == "serial":
+            processed = await run_cpu(lambda: [run_row(row) for row in rows])
+        else:
+            # gather() keeps results in input order regardless of completion order
+            processed = list(await asyncio.gather(*(run_cpu(run_row, row) for row in rows)))
+    else:
+        histories = await fill_histories(tickers, histories)
+
+        # Entry lookups that need bars older than the window get the full history first
+        deep = set()
+        for row in rows:
+            ticker = row.ticker.strip().upper()
+            if ticker in histories and needs_deep_history(ticker, histories[ticker], row.price_bought, row.date_bought):
+                deep.add(ticker)
+        deep = sorted(deep)
+        if deep:
+            histories = {**histories, **dict(zip(deep, await asyncio.gather(*(run_io(history_store.extend, t) for t in deep))))}
+
+        processed, analytics = await run_cpu(process_rows_vectorized, rows, histories, infos, var_method,
+                                              risk_levels)
+
+    apply_weights(processed)
+
+    # The book-level simulation needs the returns panel, so only the vectorized engine provides it
+    portfolio_var = None
+    if payload.portfolio_var and analytics is not None:
+        portfolio_var = await run_cpu(apply_portfolio_var, processed, analytics, var_method)
+    portfolio_risk = None
+    if payload.portfolio_var and risk_levels and analytics is not None:
+        portfolio_risk = await run_cpu(compute_portfolio_risk, processed, analytics, var_method, risk_levels)
+
+    return RecalculateResponse(rows=processed, market_sector_weights=market_sector_weights,
+                               portfolio_var=portfolio_var, portfolio_risk=portfolio_risk)
+
+
+recalc_results_cache = TTLCache(ttl_seconds=RECALC_CACHE_TTL_SECONDS, max_entries=RECALC_CACHE_MAX_ENTRIES)
+recalc_flight = AsyncSingleFlight()
+
+
+def recalc_request_key(payload: RecalculateRequest) -> str:
+    """
+    Hash of a normalized request together with the stored bars it is computed against:
+    only its own tickers and the market proxy, so other books refreshing theirs do not
+    invalidate it
+    """
+    tickers = sorted({row.ticker.strip().upper() for row in payload.rows} | {MARKET_PROXY})
+    document = {
+        "request": payload.model_dump(),
+        "market_data": {ticker: history_store.stamp(ticker) for ticker in tickers},
+    }
+    return hashlib.sha256(json.dumps(document, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def transient_row_error(row: PositionOut) -> bool:
+    """
+    Whether a row's error may clear on retry: market data that did not load (a failed or
+    timed-out fetch looks the same as an unknown ticker). A blank ticker or a price outside
+    the ticker's history fails the same way every time.
+    """
+    if not row.error or not row.ticker.strip():
+        return False
+    return re.fullmatch(PRICE_NOT_IN_HISTORY.format(".+"), row.error) is None
+
+
+async def compute_recalc(payload: RecalculateRequest) -> RecalculateResponse:
+    response = await recalculate_rows(payload)
+    # Keyed by the bars after the run: bars it fetched itself must not make it look stale
+    ttl = RECALC_ERROR_CACHE_TTL_SECONDS if any(transient_row_error(row) for row in response.rows) else None
+    recalc_results_cache.set(recalc_request_key(payload), response, ttl)
+    return response
+
+
+async def recalculate_shared(payload: RecalculateRequest) -> RecalculateResponse:
+    """
+    recalculate_rows shared between identical requests. Rows are normalized (a blank
+    date_bought is no date, as the grid sends it) and sorted into a canonical order, so the
+    same book posted in any order maps to one cached response (reordered back for each
+    caller); concurrent identical requests share one computation.
+    """
+    normalized = [row if row.date_bought else row.model_copy(update={"date_bought": None}) for row in payload.rows]
+    sort_keys = [json.dumps(row.model_dump(), sort_keys=True) for row in normalized]
+    order = sorted(range(len(normalized)), key=sort_keys.__getitem__)
+    canonical = payload.model_copy(update={"rows": [normalized[i] for i in order]})
+
+    key = recalc_request_key(canonical)
+    response = recalc_results_cache.get(key)
+    if response is None:
+        response = await recalc_flight.do(key, compute_recalc, canonical)
+
+    rows: List[Optional[PositionOut]] = [None] * len(order)
+    for position, i in enumerate(order):
+        rows[i] = response.rows[position]
+    # Sector weights come from their own cache and may have loaded since the response was computed
+    return response.model_copy(update={"rows": rows, "market_sector_weights": get_market_sector_weights()})
+
+
+@app.post("/recalculate", response_model=RecalculateResponse, dependencies=[Depends(require_user)])
+async def recalculate(payload: RecalculateRequest):
+    if not payload.rows:
+        return RecalculateResponse(rows=[])
+    try:
+        return await asyncio.wait_for(recalculate_shared(payload), timeout=RECALC_DEADLINE_SECONDS)
+    except asyncio.TimeoutError:
+        print(f"❌ /recalculate exceeded {RECALC_DEADLINE_SECONDS}s deadline ({len(payload.rows)} rows)")
+        raise HTTPException(status_code=504, detail="Recalculation timed out, please retry")
+
+
+# Per-row fields of the final /recalculate/stream frame, known only once every row is in
+STREAM_PORTFOLIO_ROW_FIELDS = ("weight", "beta_weighted", "weighted_expected_return", "var_contribution")
+
+
+async def stream_recalculation(payload: RecalculateRequest) -> AsyncIterator[dict]:
+    """
+    Recalc frames in the order they become available: a "row" frame for each row as soon
+    as its own analytics finish (completion order, with its index in the request), then a
+    "portfolio" frame with what needs every row: weights, weighted beta and expected
+    return, VaR contributions, book VaR and the sector weights. Rows run on the per-row
+    path and fetch their own ticker's history and fundamentals (shared with concurrent
+    fetches of the same ticker), so a row waits only on its ticker and the market proxy,
+    never on the rest of the book.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RECALC_DEADLINE_SECONDS
+    rows = payload.rows
+    var_method = payload.var_method or VAR_METHOD
+    risk_levels = payload.risk_levels()
+    tickers = sorted({row.ticker.strip().upper() for row in rows if row.ticker and row.ticker.strip()})
+
+    market_sector_weights = get_market_sector_weights()
+    market_history = await asyncio.wait_for(run_io(history_store.get, MARKET_PROXY), deadline - loop.time())
+    market = await run_cpu(get_market_moments, market_history)
+
+    async def run_row(row: PositionIn) -> PositionOut:
+        ticker = row.ticker.strip().upper()
+        history = info = None
+        if ticker:
+            try:
+                history, info = await asyncio.gather(run_io(history_store.get, ticker),
+                                                     run_io(fundamentals_cache.get, ticker))
+            except Exception as e:
+                return error_position(row, e)
+        return await run_cpu(process_row_cached, row, market, market_history, history, info, var_method,
+                             risk_levels)
+
+    processed: List[Optional[PositionOut]] = [None] * len(rows)
+    pending = {asyncio.ensure_future(run_row(row)): i for i, row in enumerate(rows)}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max(deadline - loop.time(), 0),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError
+            for task in done:
+                i = pending.pop(task)
+                processed[i] = task.result()
+                yield {"type": "row", "index": i, "row": processed[i].model_dump(mode="json")}
+    finally:
+        for task in pending:
+            task.cancel()
+
+    apply_weights(processed)
+
+    async def book_risk() -> Tuple[Optional[float], Optional[List[RiskMeasure]]]:
+        # Every row has fetched its history by now, so these come from the store
+        panel = await fill_histories(tickers, {MARKET_PROXY: market_history})
+        analytics = await run_cpu(portfolio_analytics, panel, var_method, risk_levels)
+        var = await run_cpu(apply_portfolio_var, processed, analytics, var_method)
+        risk = await run_cpu(compute_portfolio_risk, processed, analytics, var_method, risk_levels) if risk_levels else None
+        return var, risk
+
+    portfolio_var = portfolio_risk = None
+    if payload.portfolio_var and tickers:
+        portfolio_var, portfolio_risk = await asyncio.wait_for(book_risk(), max(deadline - loop.time(), 0))
+
+    yield {
+        "type": "portfolio",
+        "rows": [{"index": i, **{name: getattr(row, name) for name in STREAM_PORTFOLIO_ROW_FIELDS}}
+                 for i, row in enumerate(processed)],
+        "market_sector_weights": market_sector_weights,
+        "portfolio_var": portfolio_var,
+        "portfolio_risk": [measure.model_dump() for measure in portfolio_risk] if portfolio_risk else None,
+    }
+
+
+@app.post("/recalculate/stream", dependencies=[Depends(require_user)])
+async def recalculate_stream(payload: RecalculateRequest):
+    """/recalculate as newline-delimited JSON frames (see stream_recalculation)"""
+    async def lines():
+        try:
+            async for frame in stream_recalculation(payload):
+                yield json.dumps(frame) + "\n"
+        except asyncio.TimeoutError:
+            print(f"❌ /recalculate/stream exceeded {RECALC_DEADLINE_SECONDS}s deadline ({len(payload.rows)} rows)")
+            yield json.dumps({"type": "error", "detail": "Recalculation timed out, please retry"}) + "\n"
+        except Exception as e:
+            # The status line has already been sent, so the failure goes out as a frame
+            print(f"❌ /recalculate/stream failed: {e}")
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def market_weight(weights: Optional[Dict[str, float]], sector: str) -> float:
+    """SPY weight of a sector, whose key may be as spelled, lowercased, snake_cased or without spaces"""
+    if not weights:
+        return 0.0
+    lower = sector.lower()
+    for name in (sector, lower, lower.replace(" ", "_"), lower.replace(" ", "")):
+        if name in weights:
+            return weights[name]
+    return 0.0
+
+
+def sector_table(positions: List[PositionOut], allocations: Dict[str, float],
+                 market_weights: Optional[Dict[str, float]]) -> List[SectorRow]:
+    """Holdings, weight, target allocation and market weight per sector, like the grid's sector table"""
+    total_value = sum(row.position_value or 0 for row in positions)
+    holdings: Dict[str, Tuple[Set[str], float]] = {}
+    for row in positions:
+        sector = (row.sector or "").strip()
+        if not sector or row.error:
+            continue
+        tickers, value = holdings.get(sector, (set(), 0.0))
+        tickers.add(row.ticker)
+        holdings[sector] = (tickers, value + (row.position_value or 0))
+
+    table = []
+    for sector in sorted(set(ALL_SECTORS) | set(holdings)):
+        tickers, value = holdings.get(sector, (set(), 0.0))
+        allocation = allocations.get(sector, 0.0)
+        table.append(SectorRow(
+            sector=sector,
+            count=len(tickers),
+            total_value=round(value, 2),
+            weight=round(value / total_value, 4) if total_value else 0.0,
+            set_allocation=allocation,
+            allocation_goal=round(total_value * allocation, 2),
+            market_weight=market_weight(market_weights, sector),
+        ))
+    return table
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+@app.get("/portfolio/snapshot", response_model=PortfolioSnapshot, dependencies=[Depends(require_user)])
+async def portfolio_snapshot(request: Request):
+    """
+    The saved portfolio with its analytics in one round trip: positions, cash and sector
+    allocations are read from the database concurrently, the positions go through the
+    shared recalc path, and the result carries an ETag so an unchanged snapshot is a 304.
+    """
+    try:
+        positions, cash, allocations = await asyncio.gather(
+            run_io(get_all_positions), run_io(get_cash), run_io(get_sector_allocations),
+        )
+    except RuntimeError as e:
+        # Supabase not configured
+        raise HTTPException(status_code=503, detail=f"Database unavailable: {str(e)}")
+    except Exception as e:
+        print(f"❌ Error loading portfolio snapshot: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to load portfolio: {str(e)}")
+    entry_index.seed(positions, ATR_WINDOW, ATR_METHOD)
+
+    # Analytics run on whole shares, as the grid sends them to /recalculate, so both share
+    # one cached result; the positions still show the stored shares
+    rows = [
+        PositionIn(ticker=p["ticker"], shares=math.floor(p.get("shares") or 0),
+                   price_bought=p.get("price_bought") or 0, date_bought=p.get("date_bought"))
+        for p in positions
+    ]
+    recalculated = RecalculateResponse(rows=[], market_sector_weights=get_market_sector_weights())
+    if rows:
+        try:
+            recalculated = await asyncio.wait_for(recalculate_shared(RecalculateRequest(rows=rows)),
+                                                  timeout=RECALC_DEADLINE_SECONDS)
+        except asyncio.TimeoutError:
+            print(f"❌ /portfolio/snapshot exceeded {RECALC_DEADLINE_SECONDS}s deadline ({len(rows)} rows)")
+            raise HTTPException(status_code=504, detail="Recalculation timed out, please retry")
+
+    total_invested = round(sum(row.position_value or 0 for row in recalculated.rows), 2)
+    snapshot = PortfolioSnapshot(
+        positions=[row.model_copy(update={"shares": p.get("shares") or 0})
+                   for row, p in zip(recalculated.rows, positions)],
+        summary=PortfolioSummary(cash=cash, total_invested=total_invested,
+                                 total_portfolio_value=round(total_invested + cash, 2)),
+        sectors=sector_table(recalculated.rows, allocations, recalculated.market_sector_weights),
+        market_sector_weights=recalculated.market_sector_weights,
+        portfolio_var=recalculated.portfolio_var,
+    )
+
+    body = snapshot.model_dump_json().encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/cache/stats", dependencies=[Depends(require_user)])
+def cache_stats():
+    """Hit/miss counters of the memoized row, panel and response results"""
+    return {"row_results": row_results_cache.stats(), "panels": panel_cache.stats(),
+            "recalc_results": recalc_results_cache.stats()}
+
+
+class DeltaState:
+    """Rows and results of one portfolio as of its last /recalculate/delta version"""
+
+    def __init__(self):
+        self.version: Optional[str] = None
+        self.rows: Dict[str, PositionIn] = {}
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.portfolio: Dict[str, Any] = {}
+        # Held from applying a delta until its results are stored, so versions never fork
+        self.lock = asyncio.Lock()
+
+
+delta_states = TTLCache(ttl_seconds=DELTA_STATE_TTL_SECONDS, max_entries=DELTA_STATE_MAX_ENTRIES)
+
+
+def apply_delta(rows: Dict[str, PositionIn], payload: RecalculateDeltaRequest) -> Dict[str, PositionIn]:
+    """The rows after removals, modifications and additions (new rows go last)"""
+    rows = dict(rows)
+    for row_id in payload.removed:
+        if rows.pop(row_id, None) is None:
+            raise HTTPException(status_code=400, detail=f"Unknown row_id {row_id}")
+    for row in payload.modified:
+        if row.row_id not in rows:
+            raise HTTPException(status_code=400, detail=f"Unknown row_id {row.row_id}")
+        rows[row.row_id] = PositionIn(**row.model_dump(exclude={"row_id"}))
+    for row in payload.added:
+        if row.row_id in rows:
+            raise HTTPException(status_code=400, detail=f"Duplicate row_id {row.row_id}")
+        rows[row.row_id] = PositionIn(**row.model_dump(exclude={"row_id"}))
+    return rows
+
+
+def changed_fields(previous: Optional[Dict[str, Any]], current: Dict[str, Any]) -> Dict[str, Any]:
+    if previous is None:
+        return current
+    return {name: value for name, value in current.items() if name not in previous or previous[name] != value}
+
+
+@app.post("/recalculate/delta", response_model=RecalculateDeltaResponse)
+async def recalculate_delta(payload: RecalculateDeltaRequest, user: str = Depends(require_user)):
+    """
+    Versioned recalc: the client sends only the rows added, modified or removed since
+    base_version, and gets back only the fields that changed since then (including
+    weights of untouched rows) with a new version. An unknown or outdated base_version
+    is a 409, upon which the client starts over without one, sending every row as added.
+    """
+    key = (user, payload.portfolio_id)
+    state = delta_states.get(key)
+    if state is None:
+        if payload.base_version is not None:
+            raise HTTPException(status_code=409, detail="Unknown base_version, resend the portfolio")
+        state = DeltaState()
+        delta_states.set(key, state)
+
+    async with state.lock:
+        if payload.base_version is not None and payload.base_version != state.version:
+            raise HTTPException(status_code=409, detail="Outdated base_version, resend the portfolio")
+        start_over = payload.base_version is None
+        previous_results = {} if start_over else state.results
+        previous_portfolio = {} if start_over else state.portfolio
+
+        rows = apply_delta({} if start_over else state.rows, payload)
+        response = RecalculateResponse(rows=[], market_sector_weights=get_market_sector_weights())
+        if rows:
+            request = RecalculateRequest(rows=list(rows.values()), **payload.options())
+            try:
+                response = await asyncio.wait_for(recalculate_shared(request), timeout=RECALC_DEADLINE_SECONDS)
+            except asyncio.TimeoutError:
+                print(f"❌ /recalculate/delta exceeded {RECALC_DEADLINE_SECONDS}s deadline ({len(rows)} rows)")
+                raise HTTPException(status_code=504, detail="Recalculation timed out, please retry")
+        results = {row_id: row.model_dump() for row_id, row in zip(rows, response.rows)}
+        portfolio = response.model_dump(exclude={"rows"})
+
+        changes = {}
+        for row_id, fields in results.items():
+            changed = changed_fields(previous_results.get(row_id), fields)
+            if changed:
+                changes[row_id] = changed
+        state.version = uuid.uuid4().hex
+        state.rows, state.results, state.portfolio = rows, results, portfolio
+        delta_states.set(key, state)
+        return RecalculateDeltaResponse(
+            portfolio_id=payload.portfolio_id,
+            version=state.version,
+            rows=changes,
+            removed=[row_id for row_id in previous_results if row_id not in results],
+            portfolio=changed_fields(previous_portfolio or None, portfolio),
+        )
 
 
 # Serve static files (frontend)
@@ -0,0 +1,90 @@
+"""
+Small thread-safe in-process caches shared by all requests
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, NamedTuple, Optional
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    stored_at: float
+    expires_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+
+class TTLCache:
+    """
+    Key/value cache with a per-entry expiry time.
+    Expired entries are kept (up to max_entries) so callers can still serve a
+    stale value when a refresh fails; use get() for fresh-only lookups.
+    get() counts hits and misses, reported by stats().
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: Optional[int] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry(self, key: Hashable) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.get_entry(key)
+        hit = entry is not None and entry.fresh
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry.value if hit else default
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None):
+        now = time.time()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._entries[key] = CacheEntry(value, now, now + ttl)
+            self._entries.move_to_end(key)
+            if self.max_entries is not None:
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+    def touch(self, key: Hashable, ttl_seconds: Optional[float] = None):
+        """Extend an entry's expiry without replacing its value"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+                self._entries[key] = CacheEntry(entry.value, entry.stored_at, time.time() + ttl)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
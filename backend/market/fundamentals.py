@@ -0,0 +1,69 @@
+"""
+Ticker fundamentals cache
+Keeps the few Ticker.info fields the analytics need, separate from the price-history store
+"""
+import os
+from typing import Any, Dict, Optional
+
+from backend.market.cache import CacheEntry, TTLCache
+from backend.market.providers import MarketDataProvider, market_data_provider
+from backend.market.singleflight import market_data_flight
+
+# Ticker.info fields worth keeping; process_row reads sector and marketCap
+FUNDAMENTAL_FIELDS = [
+    "sector",
+    "industry",
+    "marketCap",
+    "shortName",
+    "currency",
+    "quoteType",
+]
+
+# Fundamentals barely move, so entries live for a week by default
+FUNDAMENTALS_TTL_SECONDS = float(os.getenv("FUNDAMENTALS_TTL_SECONDS", str(7 * 24 * 3600)))
+# After a failed lookup, wait this long before asking Yahoo again
+FUNDAMENTALS_RETRY_SECONDS = float(os.getenv("FUNDAMENTALS_RETRY_SECONDS", "900"))
+
+
+class FundamentalsCache:
+    """
+    Per-ticker cache of Ticker.info subsets. `.info` is the slowest Yahoo call,
+    so in steady state every lookup is served from memory.
+    """
+
+    def __init__(self, provider: MarketDataProvider, ttl_seconds: float = FUNDAMENTALS_TTL_SECONDS,
+                 max_entries: int = 5000):
+        self.provider = provider
+        self._cache = TTLCache(ttl_seconds=ttl_seconds, max_entries=max_entries)
+
+    def fetch(self, ticker: str) -> Dict[str, Any]:
+        info = self.provider.info(ticker) or {}
+        return {field: info.get(field) for field in FUNDAMENTAL_FIELDS if info.get(field) is not None}
+
+    def get(self, ticker: str) -> Dict[str, Any]:
+        ticker = ticker.strip().upper()
+        entry = self._cache.get_entry(ticker)
+        if entry is not None and entry.fresh:
+            return entry.value
+        # Concurrent misses for the same ticker share one .info call
+        return market_data_flight.do(("info", ticker), self._refresh, ticker, entry)
+
+    def _refresh(self, ticker: str, entry: Optional[CacheEntry]) -> Dict[str, Any]:
+        try:
+            fundamentals = self.fetch(ticker)
+        except Exception as e:
+            print(f"⚠️ Failed to fetch fundamentals for {ticker}: {e}")
+            fundamentals = None
+        if not fundamentals:
+            # Keep serving the stale copy (or an empty one) and retry later
+            fallback = entry.value if entry is not None else {}
+            self._cache.set(ticker, fallback, ttl_seconds=FUNDAMENTALS_RETRY_SECONDS)
+            return fallback
+        self._cache.set(ticker, fundamentals)
+        return fundamentals
+
+    def invalidate(self, ticker: Optional[str] = None):
+        self._cache.invalidate(ticker.strip().upper() if ticker else None)
+
+
+fundamentals_cache = FundamentalsCache(market_data_provider)
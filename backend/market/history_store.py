@@ -0,0 +1,327 @@
+"""
+Persistent OHLCV history store
+Keeps one NumPy bundle per ticker on disk and only downloads bars newer than the last stored date
+"""
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from backend.market.providers import MarketDataProvider, market_data_provider
+from backend.market.singleflight import market_data_flight
+
+OHLCV_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+# Minimum number of seconds between two network checks for the same ticker
+HISTORY_REFRESH_SECONDS = float(os.getenv("HISTORY_REFRESH_SECONDS", "30"))
+
+# Default analytic window: cold fetches only download this many years of bars.
+# Deeper history is fetched on demand (see HistoryStore.extend) and then kept.
+HISTORY_LOOKBACK_YEARS = float(os.getenv("HISTORY_LOOKBACK_YEARS", "5"))
+
+# auto_adjust=True rewrites the whole series after a split or dividend, so the re-fetched
+# overlap bar is compared with the stored one and a drift above this ratio forces a full reload
+ADJUSTMENT_TOLERANCE = 1e-4
+
+
+def _default_history_dir() -> Path:
+    env_dir = os.getenv("HISTORY_STORE_DIR", "").strip()
+    if env_dir:
+        return Path(env_dir)
+    if os.environ.get("VERCEL"):
+        # Only /tmp is writable on Vercel
+        return Path("/tmp/risksheet-history")
+    return Path(__file__).resolve().parents[2] / ".cache" / "history"
+
+
+HISTORY_DIR = _default_history_dir()
+
+
+def lookback_start(years: float = HISTORY_LOOKBACK_YEARS) -> pd.Timestamp:
+    """First date of the default analytic window"""
+    return pd.Timestamp.now().normalize() - pd.Timedelta(days=int(years * 365.25))
+
+
+def history_stamp(history: Optional[pd.DataFrame]) -> Optional[tuple]:
+    """
+    (first date, last date, last close) of a series, or None. Changes whenever the series
+    does: new or revised bars, a deeper fetch or a rebuild.
+    """
+    if history is None or history.empty:
+        return None
+    return history.index[0], history.index[-1], float(history["Close"].iloc[-1])
+
+
+def _empty_history() -> pd.DataFrame:
+    return pd.DataFrame(columns=OHLCV_COLUMNS, index=pd.DatetimeIndex([]), dtype=float)
+
+
+def _normalize(history: pd.DataFrame) -> pd.DataFrame:
+    """Keep OHLCV columns only, with a sorted, unique, timezone-naive index"""
+    if history is None or history.empty:
+        return _empty_history()
+    history = history[[c for c in OHLCV_COLUMNS if c in history.columns]].astype(float)
+    if history.index.tz is not None:
+        history.index = history.index.tz_localize(None)
+    history = history[~history.index.duplicated(keep="last")].sort_index()
+    return history
+
+
+class HistoryStore:
+    """
+    On-disk columnar store of daily bars, one `<TICKER>.npz` bundle per ticker.
+    The first request for a ticker downloads the default lookback window; later
+    requests only download bars from the last stored date onwards and append them.
+    The full listing history is only fetched when extend() asks for it.
+    """
+
+    def __init__(self, root: Path, provider: MarketDataProvider):
+        self.root = Path(root)
+        self.provider = provider
+        self._frames: Dict[str, pd.DataFrame] = {}
+        self._checked_at: Dict[str, float] = {}
+        # Tickers whose stored series goes back to the first listed bar
+        self._complete: Dict[str, bool] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, ticker: str) -> threading.Lock:
+        with self._locks_guard:
+            if ticker not in self._locks:
+                self._locks[ticker] = threading.Lock()
+            return self._locks[ticker]
+
+    def path_for(self, ticker: str) -> Path:
+        # Tickers like BRK-B or ^GSPC are fine, but never let a ticker escape the store directory
+        safe_name = re.sub(r"[^A-Za-z0-9._^=-]", "_", ticker)
+        return self.root / f"{safe_name}.npz"
+
+    def load(self, ticker: str) -> Optional[pd.DataFrame]:
+        """Return the stored history for a ticker without touching the network"""
+        if ticker in self._frames:
+            return self._frames[ticker]
+        path = self.path_for(ticker)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as bundle:
+                history = pd.DataFrame(
+                    {col: bundle[col] for col in OHLCV_COLUMNS},
+                    index=pd.DatetimeIndex(bundle["Date"]),
+                )
+                self._complete[ticker] = bool(bundle["Complete"]) if "Complete" in bundle.files else False
+        except Exception as e:
+            print(f"⚠️ Discarding unreadable history file {path}: {e}")
+            return None
+        self._frames[ticker] = history
+        return history
+
+    def save(self, ticker: str, history: pd.DataFrame):
+        """Write the history bundle atomically so concurrent readers never see a partial file"""
+        self._frames[ticker] = history
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            path = self.path_for(ticker)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    Date=history.index.to_numpy(dtype="datetime64[ns]"),
+                    Complete=np.array(self._complete.get(ticker, False)),
+                    **{col: history[col].to_numpy(dtype=float) for col in OHLCV_COLUMNS},
+                )
+            os.replace(tmp_path, path)
+        except Exception as e:
+            # The in-memory copy is still valid, only persistence failed
+            print(f"⚠️ Failed to persist history for {ticker}: {e}")
+
+    def stamp(self, ticker: str) -> Optional[tuple]:
+        """history_stamp of the series held in memory, without touching the disk"""
+        return history_stamp(self._frames.get(ticker.upper()))
+
+    def download(self, ticker: str, start: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+        return self.download_many([ticker], start=start)[ticker]
+
+    def is_complete(self, ticker: str) -> bool:
+        """True when the stored series already starts at the ticker's first listed bar"""
+        return self._complete.get(ticker.upper(), False)
+
+    def _reload_start(self, ticker: str) -> Optional[pd.Timestamp]:
+        # Rebuilds keep the depth that was already stored
+        return None if self._complete.get(ticker) else lookback_start()
+
+    def _mark_depth(self, ticker: str, history: pd.DataFrame, start: Optional[pd.Timestamp]):
+        # A window fetch that starts well after the window start means the ticker listed inside it
+        complete = start is None or (not history.empty and history.index[0] > start + pd.Timedelta(days=10))
+        self._complete[ticker] = complete
+
+    def download_many(self, tickers: List[str], start: Optional[pd.Timestamp] = None) -> Dict[str, pd.DataFrame]:
+        """Download several tickers in one provider call (one bulk request for yfinance)"""
+        if not tickers:
+            return {}
+        frames = self.provider.history(tickers, start=start)
+        return {ticker: _normalize(frames.get(ticker)) for ticker in tickers}
+
+    def merge(self, stored: pd.DataFrame, fresh: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """
+        Append freshly downloaded bars to the stored series.
+        Returns None when the overlapping bar no longer matches, meaning the
+        provider re-adjusted the history and the stored copy must be rebuilt.
+        """
+        if fresh.empty:
+            return stored
+        first_fresh = fresh.index[0]
+        if first_fresh in stored.index:
+            old_close = stored.at[first_fresh, "Close"]
+            new_close = fresh.at[first_fresh, "Close"]
+            if old_close and abs(new_close - old_close) / abs(old_close) > ADJUSTMENT_TOLERANCE:
+                return None
+        return pd.concat([stored[stored.index < first_fresh], fresh])
+
+    def get(self, ticker: str) -> pd.DataFrame:
+        """
+        Return the full daily history for a ticker, downloading only what is missing.
+        Concurrent calls for the same ticker share one fetch.
+        """
+        ticker = ticker.upper()
+        return market_data_flight.do(("history", ticker), self._get, ticker)
+
+    def get_many(self, tickers: Iterable[str]) -> Dict[str, pd.DataFrame]:
+        """
+        Batch version of get(). Tickers another request is already fetching are awaited
+        rather than downloaded again.
+        """
+        keys = [("history", t) for t in sorted({t.upper() for t in tickers if t})]
+
+        def fetch(owned_keys):
+            histories = self._get_many([ticker for _, ticker in owned_keys])
+            return {("history", ticker): history for ticker, history in histories.items()}
+
+        return {ticker: history for (_, ticker), history in market_data_flight.do_many(keys, fetch).items()}
+
+    def _get(self, ticker: str) -> pd.DataFrame:
+        with self._lock_for(ticker):
+            stored = self.load(ticker)
+            if stored is not None and not stored.empty:
+                if time.time() - self._checked_at.get(ticker, 0.0) < HISTORY_REFRESH_SECONDS:
+                    return stored
+                # Re-fetch from the second-to-last bar: the last one may have been an unfinished
+                # session, while the one before it is final and used to detect re-adjustments
+                overlap_start = stored.index[-2] if len(stored) > 1 else stored.index[-1]
+                fresh = self.download(ticker, start=overlap_start)
+                merged = self.merge(stored, fresh)
+                if merged is None:
+                    print(f"ℹ️ {ticker} history was re-adjusted upstream, reloading it")
+                    start = self._reload_start(ticker)
+                    merged = self.download(ticker, start=start)
+                    self._mark_depth(ticker, merged, start)
+                history = merged
+            else:
+                start = lookback_start()
+                history = self.download(ticker, start=start)
+                self._mark_depth(ticker, history, start)
+
+            self._checked_at[ticker] = time.time()
+            if history.empty:
+                return history
+            if stored is None or not history.equals(stored):
+                self.save(ticker, history)
+            return history
+
+    def _get_many(self, tickers: List[str]) -> Dict[str, pd.DataFrame]:
+        """
+        Tickers that need the network are fetched in bulk downloads, one per start date
+        (cold tickers by window, tickers that only need new bars by their last stored bar).
+        """
+        locks = [self._lock_for(t) for t in tickers]
+        # Sorted acquisition order keeps concurrent batches from deadlocking each other
+        for lock in locks:
+            lock.acquire()
+        try:
+            result: Dict[str, pd.DataFrame] = {}
+            stored_frames: Dict[str, pd.DataFrame] = {}
+            cold: List[str] = []
+            warm: List[str] = []
+            now = time.time()
+            for ticker in tickers:
+                stored = self.load(ticker)
+                if stored is None or stored.empty:
+                    cold.append(ticker)
+                elif now - self._checked_at.get(ticker, 0.0) < HISTORY_REFRESH_SECONDS:
+                    result[ticker] = stored
+                else:
+                    stored_frames[ticker] = stored
+                    warm.append(ticker)
+
+            # Warm tickers re-fetch from their own last overlap bar, one download per start date, so a
+            # ticker left stale for weeks does not drag the whole batch back with it
+            overlap_starts = {
+                t: stored_frames[t].index[-2] if len(stored_frames[t]) > 1 else stored_frames[t].index[-1]
+                for t in warm
+            }
+            fresh_frames: Dict[str, pd.DataFrame] = {}
+            for start in set(overlap_starts.values()):
+                group = [t for t in warm if overlap_starts[t] == start]
+                fresh_frames.update(self.download_many(group, start=start))
+            for ticker in warm:
+                merged = self.merge(stored_frames[ticker], fresh_frames.get(ticker, _empty_history()))
+                if merged is None:
+                    print(f"ℹ️ {ticker} history was re-adjusted upstream, reloading it")
+                    cold.append(ticker)
+                else:
+                    result[ticker] = merged
+
+            # Cold tickers get the default window, re-adjusted complete series are rebuilt in full
+            starts = {t: self._reload_start(t) if t in stored_frames else lookback_start() for t in cold}
+            for start in set(starts.values()):
+                group = [t for t in cold if starts[t] == start]
+                downloaded = self.download_many(group, start=start)
+                for ticker in group:
+                    self._mark_depth(ticker, downloaded.get(ticker, _empty_history()), start)
+                result.update(downloaded)
+
+            checked_at = time.time()
+            for ticker in tickers:
+                if ticker in result and ticker not in stored_frames and ticker not in cold:
+                    continue  # served from memory, nothing new
+                self._checked_at[ticker] = checked_at
+                history = result.get(ticker, _empty_history())
+                result[ticker] = history
+                if not history.empty and (ticker not in stored_frames or not history.equals(stored_frames[ticker])):
+                    self.save(ticker, history)
+            return result
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def extend(self, ticker: str) -> pd.DataFrame:
+        """
+        Deep fetch: download the ticker's full listing history once and keep it, for
+        lookups (like entry-date inference) that need bars older than the default window.
+        """
+        ticker = ticker.upper()
+        return market_data_flight.do(("history_max", ticker), self._extend, ticker)
+
+    def _extend(self, ticker: str) -> pd.DataFrame:
+        with self._lock_for(ticker):
+            stored = self.load(ticker)
+            if stored is not None and self._complete.get(ticker):
+                return stored
+            print(f"ℹ️ Fetching full history for {ticker} (older than the {HISTORY_LOOKBACK_YEARS:g}y window)")
+            history = self.download(ticker)
+            if history.empty:
+                return stored if stored is not None else history
+            if stored is not None and not stored.empty:
+                # Keep the freshest bars from the stored copy if the deep fetch lags behind it
+                history = pd.concat([history, stored[stored.index > history.index[-1]]])
+            self._complete[ticker] = True
+            self._checked_at[ticker] = time.time()
+            self.save(ticker, history)
+            return history
+
+
+history_store = HistoryStore(HISTORY_DIR, market_data_provider)
@@ -0,0 +1,173 @@
+"""
+Market data providers
+Every network-facing market data call goes through a MarketDataProvider, so the analytics
+can run against yfinance in production or against local fixture files offline
+"""
+import json
+import os
+import re
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import yfinance as yf
+
+
+def _fixture_name(ticker: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._^=-]", "_", ticker.upper())
+
+
+class MarketDataProvider(ABC):
+    """Source of daily bars, ticker fundamentals and index sector weights"""
+
+    name = "base"
+
+    @abstractmethod
+    def history(self, tickers: List[str], start: Optional[pd.Timestamp] = None,
+                end: Optional[pd.Timestamp] = None) -> Dict[str, pd.DataFrame]:
+        """
+        Daily auto-adjusted OHLCV bars per ticker, from `start` (or the first listed bar
+        when None) up to `end` (or the latest bar when None). Unknown tickers map to an
+        empty frame.
+        """
+
+    @abstractmethod
+    def info(self, ticker: str) -> Dict[str, Any]:
+        """Ticker metadata in the shape of yfinance's Ticker.info"""
+
+    @abstractmethod
+    def sector_weights(self, proxy: str) -> Dict[str, float]:
+        """Sector weightings of an index fund such as SPY"""
+
+
+class YFinanceProvider(MarketDataProvider):
+    """Live data from Yahoo Finance; several tickers are fetched in one bulk download"""
+
+    name = "yfinance"
+
+    def history(self, tickers: List[str], start: Optional[pd.Timestamp] = None,
+                end: Optional[pd.Timestamp] = None) -> Dict[str, pd.DataFrame]:
+        if not tickers:
+            return {}
+        kwargs: Dict[str, Any] = {}
+        if start is None and end is None:
+            kwargs["period"] = "max"
+        if start is not None:
+            kwargs["start"] = start.strftime("%Y-%m-%d")
+        if end is not None:
+            kwargs["end"] = end.strftime("%Y-%m-%d")
+        data = yf.download(
+            tickers,
+            group_by="ticker",
+            auto_adjust=True,
+            progress=False,
+            threads=True,
+            **kwargs,
+        )
+        result = {}
+        for ticker in tickers:
+            if data is None or data.empty:
+                frame = pd.DataFrame()
+            elif isinstance(data.columns, pd.MultiIndex):
+                frame = data[ticker] if ticker in data.columns.get_level_values(0) else pd.DataFrame()
+            else:
+                frame = data if len(tickers) == 1 else pd.DataFrame()
+            if not frame.empty:
+                # Bulk downloads share one date index, so drop days where this ticker did not trade
+                frame = frame.dropna(subset=["Close"])
+            result[ticker] = frame
+        return result
+
+    def info(self, ticker: str) -> Dict[str, Any]:
+        return yf.Ticker(ticker).info or {}
+
+    def sector_weights(self, proxy: str) -> Dict[str, float]:
+        fund = yf.Ticker(proxy)
+        # Try funds_data (newer yfinance)
+        try:
+            if hasattr(fund, 'funds_data') and fund.funds_data and fund.funds_data.sector_weightings:
+                return fund.funds_data.sector_weightings
+        except Exception as e:
+            print(f"⚠️ funds_data lookup failed for {proxy}: {e}")
+
+        # Fallback to info
+        info = fund.info
+        if 'sectorWeightings' in info:
+            # Usually a list of dicts: [{'sector': '...', 'weight': ...}]
+            sw = info['sectorWeightings']
+            if isinstance(sw, list):
+                return {item['sector']: item['weight'] for item in sw}
+            elif isinstance(sw, dict):
+                return sw
+
+        return {}
+
+
+class LocalFileProvider(MarketDataProvider):
+    """
+    Offline provider reading fixture files, for benchmarks, load tests and CI:
+        <root>/history/<TICKER>.csv          Date,Open,High,Low,Close,Volume
+        <root>/info/<TICKER>.json            Ticker.info subset
+        <root>/sector_weights/<PROXY>.json   {"technology": 0.31, ...}
+    Missing files behave like an unknown ticker. export_market_fixtures.py writes this layout.
+    """
+
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._frames: Dict[str, pd.DataFrame] = {}
+
+    def _load_history(self, ticker: str) -> pd.DataFrame:
+        if ticker not in self._frames:
+            path = self.root / "history" / f"{_fixture_name(ticker)}.csv"
+            if path.exists():
+                frame = pd.read_csv(path, index_col="Date", parse_dates=["Date"])
+            else:
+                frame = pd.DataFrame()
+            self._frames[ticker] = frame
+        return self._frames[ticker]
+
+    def _load_json(self, folder: str, name: str) -> Dict[str, Any]:
+        path = self.root / folder / f"{_fixture_name(name)}.json"
+        if not path.exists():
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def history(self, tickers: List[str], start: Optional[pd.Timestamp] = None,
+                end: Optional[pd.Timestamp] = None) -> Dict[str, pd.DataFrame]:
+        result = {}
+        for ticker in tickers:
+            frame = self._load_history(ticker)
+            if not frame.empty:
+                if start is not None:
+                    frame = frame[frame.index >= start]
+                if end is not None:
+                    frame = frame[frame.index < end]
+            result[ticker] = frame
+        return result
+
+    def info(self, ticker: str) -> Dict[str, Any]:
+        return self._load_json("info", ticker)
+
+    def sector_weights(self, proxy: str) -> Dict[str, float]:
+        return self._load_json("sector_weights", proxy)
+
+
+def create_provider() -> MarketDataProvider:
+    """Provider selected by MARKET_DATA_PROVIDER ("yfinance" or "local" with MARKET_DATA_DIR)"""
+    kind = os.getenv("MARKET_DATA_PROVIDER", "yfinance").strip().lower()
+    if kind == "local":
+        root = os.getenv("MARKET_DATA_DIR", "").strip()
+        if not root:
+            raise RuntimeError("MARKET_DATA_PROVIDER=local requires MARKET_DATA_DIR to point at the fixture directory")
+        print(f"ℹ️ Using local market data fixtures from {root}")
+        return LocalFileProvider(Path(root))
+    if kind != "yfinance":
+        raise RuntimeError(f"Unknown MARKET_DATA_PROVIDER '{kind}' (expected 'yfinance' or 'local')")
+    return YFinanceProvider()
+
+
+market_data_provider = create_provider()
@@ -0,0 +1,110 @@
+"""
+Single-flight request coalescing
+Concurrent callers asking for the same key share one in-flight call instead of each issuing their own
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List
+
+
+class SingleFlight:
+    """
+    The first caller for a key (the leader) runs the function; callers arriving
+    while it is in flight wait on the leader's future and get the same result or
+    exception. Nothing is cached once the call completes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def do_many(self, keys: Iterable[Hashable], fn: Callable[[List[Hashable]], Dict[Hashable, Any]]) -> Dict[Hashable, Any]:
+        """
+        Batch variant: `fn` receives only the keys nobody else is already fetching and
+        must return a dict keyed by them; keys already in flight are awaited instead.
+        """
+        owned: Dict[Hashable, Future] = {}
+        waiting: Dict[Hashable, Future] = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                future = self._inflight.get(key)
+                if future is None:
+                    future = Future()
+                    self._inflight[key] = future
+                    owned[key] = future
+                else:
+                    waiting[key] = future
+
+        results: Dict[Hashable, Any] = {}
+        if owned:
+            try:
+                results = fn(list(owned))
+            except BaseException as e:
+                for future in owned.values():
+                    future.set_exception(e)
+                raise
+            else:
+                for key, future in owned.items():
+                    future.set_result(results.get(key))
+            finally:
+                with self._lock:
+                    for key in owned:
+                        self._inflight.pop(key, None)
+
+        # Own work first, then wait for the rest, so two overlapping batches never block each other
+        merged = {key: results.get(key) for key in owned}
+        for key, future in waiting.items():
+            merged[key] = future.result()
+        return merged
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop: the leader's coroutine runs as a task
+    that every caller for the key awaits. A caller that gives up (a timeout, a dropped
+    connection) only stops waiting; the task still finishes for the others.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here so an error nobody awaited is not logged as lost
+
+
+# Shared by every market-data fetch; keys are (kind, ticker) tuples
+market_data_flight = SingleFlight()
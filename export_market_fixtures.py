@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Export market data fixtures for the offline LocalFileProvider
+Usage: python export_market_fixtures.py <output_dir> AAPL MSFT ...
+Then run the backend with MARKET_DATA_PROVIDER=local MARKET_DATA_DIR=<output_dir>
+"""
+import json
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from backend.market.fundamentals import FUNDAMENTAL_FIELDS
+from backend.market.history_store import lookback_start
+from backend.market.providers import YFinanceProvider, _fixture_name
+
+MARKET_PROXY = "SPY"
+
+
+def export_fixtures(root: Path, tickers):
+    provider = YFinanceProvider()
+    tickers = sorted({t.strip().upper() for t in tickers if t.strip()} | {MARKET_PROXY})
+    for folder in ("history", "info", "sector_weights"):
+        (root / folder).mkdir(parents=True, exist_ok=True)
+
+    print(f"Downloading {len(tickers)} tickers...")
+    histories = provider.history(tickers, start=lookback_start())
+    for ticker in tickers:
+        history = histories.get(ticker)
+        if history is None or history.empty:
+            print(f"  ⚠️ {ticker}: no history, skipped")
+            continue
+        history = history[["Open", "High", "Low", "Close", "Volume"]]
+        history.index = history.index.tz_localize(None) if history.index.tz is not None else history.index
+        history.to_csv(root / "history" / f"{_fixture_name(ticker)}.csv", index_label="Date")
+
+        info = provider.info(ticker)
+        with open(root / "info" / f"{_fixture_name(ticker)}.json", "w") as f:
+            json.dump({k: info.get(k) for k in FUNDAMENTAL_FIELDS if info.get(k) is not None}, f, indent=2)
+        print(f"  ✅ {ticker}: {len(history)} bars")
+
+    with open(root / "sector_weights" / f"{MARKET_PROXY}.json", "w") as f:
+        json.dump(provider.sector_weights(MARKET_PROXY), f, indent=2)
+    print(f"✅ Fixtures written to {root}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    export_fixtures(Path(sys.argv[1]), sys.argv[2:])
@@ -3,9 +3,17 @@ CREATE TABLE positions (
   ticker TEXT PRIMARY KEY,
   shares REAL NOT NULL,
   price_bought REAL NOT NULL,
-  date_bought TEXT
+  date_bought TEXT,
+  entry_date TEXT,
+  entry_atr REAL,
+  entry_key TEXT
 );
 
+-- Existing deployments: inferred entry date and entry ATR, stored with the inputs they came from
+ALTER TABLE positions ADD COLUMN IF NOT EXISTS entry_date TEXT;
+ALTER TABLE positions ADD COLUMN IF NOT EXISTS entry_atr REAL;
+ALTER TABLE positions ADD COLUMN IF NOT EXISTS entry_key TEXT;
+
 -- Create cash table
 CREATE TABLE cash (
   id INTEGER PRIMARY KEY CHECK (id = 1),